@@ -1,57 +1,616 @@
 #!/usr/bin/env /opt/cloudera/parcels/CDH-7.1.7-1.cdh7.1.7.p0.15945976/lib/hue/build/env/bin/python
 
 import sys
-from utility import ScriptConfiguration, Logger
+import os
+from utility import ScriptConfiguration, Logger, LookupTableCache, RecordIdAllocator, LruCache, Metrics, LazyImport
 import logging
 from logging.handlers import RotatingFileHandler
 import json
-from jsonschema import validate, ValidationError
 from datetime import datetime
-from dateutil.parser import parse
-from dateutil import parser
-import pytz
 from copy import deepcopy
 import traceback
 import unicodedata
+import re
+import hashlib
+import sqlite3
+import tempfile
+import gzip
+import io
+from itertools import islice, product
+from numbers import Number
+
+# librerie pesanti importate al primo utilizzo (numpy e' opzionale)
+jsonschemaValidators = LazyImport("jsonschema.validators")
+jsonschemaExceptions = LazyImport("jsonschema.exceptions")
+parser = LazyImport("dateutil.parser")
+pytz = LazyImport("pytz")
+np = LazyImport("numpy", optional=True)
+# nomi importati in passato a livello di modulo, risolti al primo accesso (es. from dataQuality import ValidationError)
+LAZY_NAMES = {
+    "ValidationError": (jsonschemaExceptions, "ValidationError"),
+    "best_match": (jsonschemaExceptions, "best_match"),
+    "validator_for": (jsonschemaValidators, "validator_for"),
+    "validate": (jsonschemaValidators, "validate"),
+    "parse": (parser, "parse")
+}
+
+
+def __getattr__(name):
+    if name in LAZY_NAMES:
+        module, attr = LAZY_NAMES[name]
+        return getattr(module, attr)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+try:
+    basestring
+except NameError:
+    basestring = unicode = str
+
+class SpecialCharReplacer(object):
+    ''' Motore di sostituzione dei caratteri speciali compilato a partire dalle righe di special_char_table
+        (carattere/sequenza, sostituto). La stringa viene riscritta in un'unica passata:
+        - se tutte le chiavi sono caratteri singoli viene usata una tabella di str.translate;
+        - altrimenti un'unica espressione regolare in alternanza, con le chiavi piu' lunghe provate per prime.
+        A parita' di chiave vale la prima riga della tabella; i sostituti non vengono riesaminati.
+    '''
+
+    def __init__(self, rows):
+        self.mapping = dict()
+        for record in rows:
+            if record[0] and record[0] not in self.mapping:
+                self.mapping[record[0]] = record[1] if record[1] else ""
+        self.table = None
+        self.pattern = None
+        if all(len(k) == 1 for k in self.mapping):
+            self.table = dict((ord(k), v) for k, v in self.mapping.items())
+        else:
+            multi = sorted((k for k in self.mapping if len(k) > 1), key=len, reverse=True)
+            single = [k for k in self.mapping if len(k) == 1]
+            alternatives = [re.escape(k) for k in multi]
+            if single:
+                alternatives.append("[{}]".format("".join(re.escape(k) for k in single)))
+            self.pattern = re.compile("|".join(alternatives))
+
+    def _sub(self, match):
+        return self.mapping[match.group(0)]
+
+    def replace(self, string):
+        if isinstance(string, bytes):
+            string = string.decode('utf-8')
+        if self.table is not None:
+            return string.translate(self.table)
+        return self.pattern.sub(self._sub, string)
+
+    def replaceMany(self, strings):
+        return [self.replace(string) for string in strings]
+
+
+class FingerprintSet(object):
+    ''' Insieme di fingerprint (bytes) usato per la deduplica in streaming. Finche' il numero di fingerprint resta
+        entro max_memory (None = nessun limite) l'insieme vive in memoria; oltre viene riversato in un database
+        sqlite temporaneo su disco, interrogato per chiave primaria. '''
+
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory
+        self.memory = set()
+        self.db = None
+        self.db_path = None
+
+    def add(self, fingerprint):
+        ''' Aggiunge il fingerprint e ritorna True se non era gia' presente. '''
+        if fingerprint in self.memory:
+            return False
+        if self.db is not None and self.db.execute("SELECT 1 FROM fp WHERE h = ?", (fingerprint,)).fetchone():
+            return False
+        self.memory.add(fingerprint)
+        if self.max_memory is not None and len(self.memory) > self.max_memory:
+            self.spill()
+        return True
+
+    def spill(self):
+        if self.db is None:
+            fd, self.db_path = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute("CREATE TABLE fp (h BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.db.executemany("INSERT OR IGNORE INTO fp VALUES (?)", ((h,) for h in self.memory))
+        self.db.commit()
+        self.memory = set()
+
+    def close(self):
+        self.memory = set()
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = None
+
+
+class DateParser(object):
+    ''' Parser di date con fast path a espressioni regolari compilate. I formati gestiti sono solo quelli che
+        dateutil interpreta allo stesso modo (anno a 4 cifre, mese prima del giorno): per ogni altro valore, o se il
+        valore non corrisponde a nessun formato, si ricade su dateutil.parser.parse.
+        Il formato dell'ultimo valore riconosciuto viene provato per primo alla chiamata successiva.
+    '''
+    FORMATS = ["%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%S.%f",
+               "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d", "%Y/%m/%d %H:%M:%S", "%Y/%m/%d",
+               "%m/%d/%Y %H:%M:%S", "%m/%d/%Y", "%m-%d-%Y"]
+    TOKENS = {"%Y": r"(?P<Y>\d{4})", "%m": r"(?P<m>\d{1,2})", "%d": r"(?P<d>\d{1,2})", "%H": r"(?P<H>\d{1,2})",
+              "%M": r"(?P<M>\d{1,2})", "%S": r"(?P<S>\d{1,2})", "%f": r"(?P<f>\d{1,6})"}
+
+    def __init__(self, formats=None):
+        self.formats = formats if formats else self.FORMATS
+        self.patterns = dict((fmt, self.compileFormat(fmt)) for fmt in self.formats)
+        self.last = self.formats[0]
+        self.hits = 0
+        self.fallbacks = 0
+
+    def compileFormat(self, fmt):
+        regex = "".join(self.TOKENS.get(token, re.escape(token)) for token in re.findall(r"%.|[^%]+", fmt))
+        return re.compile(regex + "$")
+
+    def match(self, value, fmt):
+        m = self.patterns[fmt].match(value)
+        if m is None:
+            return None
+        g = m.groupdict()
+        try:
+            return datetime(int(g["Y"]), int(g["m"]), int(g["d"]), int(g.get("H") or 0), int(g.get("M") or 0),
+                int(g.get("S") or 0), int((g.get("f") or "0").ljust(6, "0")))
+        except ValueError:
+            return None
+
+    def infer(self, values, sample_size=100):
+        ''' Ritorna il formato prevalente in un campione dei valori in input (None se nessun formato e' riconosciuto). '''
+        counts = dict()
+        for value in islice(values, sample_size):
+            if isinstance(value, str):
+                for fmt in self.formats:
+                    if self.match(value, fmt) is not None:
+                        counts[fmt] = counts.get(fmt, 0) + 1
+                        break
+        return max(counts, key=counts.get) if counts else None
+
+    def parse(self, value, fmt=None, fuzzy=False):
+        ''' Ritorna il datetime (naive) corrispondente al valore, provando prima il formato fmt (o l'ultimo
+            riconosciuto), poi gli altri formati e infine dateutil. Solleva le stesse eccezioni di dateutil. '''
+        if isinstance(value, str):
+            fmt = fmt if fmt else self.last
+            date = self.match(value, fmt)
+            if date is None:
+                for other in self.formats:
+                    if other != fmt:
+                        date = self.match(value, other)
+                        if date is not None:
+                            self.last = other
+                            break
+            if date is not None:
+                self.hits += 1
+                return date
+        self.fallbacks += 1
+        return parser.parse(value, fuzzy=fuzzy).replace(tzinfo=None)
+
+    def getStats(self):
+        return {"hits": self.hits, "fallbacks": self.fallbacks, "last_format": self.last}
+
+
+class JsonRecordReader(object):
+    ''' Lettura in streaming di record json da file NDJSON (un json per riga) oppure da un unico array json al primo
+        livello, anche compressi in gzip (riconosciuti dal magic number). Il formato ("ndjson" o "array") di default
+        viene dedotto dal primo carattere significativo. Il file viene letto a blocchi di buffer_size caratteri:
+        la memoria occupata dipende dalla dimensione dei blocchi e del singolo record, non da quella del file.
+    '''
+    GZIP_MAGIC = b"\x1f\x8b"
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, path, format=None, buffer_size=1 << 16, encoding="utf-8"):
+        self.path = path
+        self.format = format
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.records = 0
+
+    def open(self):
+        with open(self.path, "rb") as raw:
+            compressed = raw.read(2) == self.GZIP_MAGIC
+        if compressed:
+            return io.TextIOWrapper(gzip.open(self.path, "rb"), encoding=self.encoding)
+        return open(self.path, "r", encoding=self.encoding)
+
+    def __iter__(self):
+        with self.open() as stream:
+            if self.format == "ndjson":
+                records = self.iterLines(stream)
+            else:
+                buf = stream.read(self.buffer_size)
+                while buf and not buf.strip(self.WHITESPACE):
+                    buf = stream.read(self.buffer_size)
+                buf = buf.lstrip(self.WHITESPACE)
+                if self.format == "array" or buf[:1] == "[":
+                    records = self.iterArray(stream, buf[1:])
+                else:
+                    records = self.iterLines(stream, buf)
+            for record in records:
+                yield record
+
+    def iterLines(self, stream, head=""):
+        decoder = json.JSONDecoder()
+        for line in self.chainLines(stream, head):
+            line = line.strip()
+            if line:
+                self.records += 1
+                yield decoder.decode(line)
+
+    def chainLines(self, stream, head):
+        ''' Righe del file, considerando anche la parte gia' letta (head) per riconoscere il formato. '''
+        if head:
+            lines = io.StringIO(head).readlines()
+            if not lines[-1].endswith("\n"):
+                lines[-1] += stream.readline()
+            for line in lines:
+                yield line
+        for line in stream:
+            yield line
+
+    def iterArray(self, stream, buf):
+        ''' Decodifica incrementale degli elementi dell'array con JSONDecoder.raw_decode: un elemento e' completo
+            solo se nel buffer e' gia' presente il separatore successivo ("," o "]"), altrimenti (elemento troncato
+            o che potrebbe proseguire, es. un numero spezzato in "1." e "5") viene letto il blocco successivo. '''
+        decoder = json.JSONDecoder()
+        pos = 0
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in self.WHITESPACE + ",":
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError("JsonRecordReader - array json non terminato in '{}'".format(self.path))
+                buf, pos = stream.read(self.buffer_size), 0
+                eof = not buf
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                after = end
+                while after < len(buf) and buf[after] in self.WHITESPACE:
+                    after += 1
+                complete = after < len(buf) and buf[after] in ",]"
+                if not complete and eof:
+                    raise ValueError("JsonRecordReader - array json non valido in '{}'".format(self.path))
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                more = stream.read(max(self.buffer_size, len(buf) - pos))
+                eof = not more
+                buf, pos = buf[pos:] + more, 0
+                continue
+            self.records += 1
+            yield record
+            pos = end
+
+
+class JsonRecordWriter(object):
+    ''' Scrittura bufferizzata di record json (NDJSON, oppure array json con as_array=True) su path: i record
+        vengono serializzati e scritti a blocchi di batch_size su un file temporaneo nella stessa cartella, che viene
+        rinominato atomicamente su path solo alla chiusura (commit). In caso di errore (abort) il file di
+        destinazione non viene toccato. Se path termina con ".gz" (o compress=True) l'output e' compresso in gzip.
+    '''
+
+    def __init__(self, path, batch_size=1000, as_array=False, compress=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.as_array = as_array
+        self.compress = path.endswith(".gz") if compress is None else compress
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(path)), suffix=".tmp",
+                                             dir=os.path.dirname(os.path.abspath(path)))
+        raw = os.fdopen(fd, "wb")
+        self.stream = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb") if self.compress else raw, encoding="utf-8")
+        self.raw = raw
+        self.buffer = []
+        self.records = 0
+        if self.as_array:
+            self.stream.write("[")
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record, default=str))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def writeMany(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.buffer:
+            sep = ",\n" if self.as_array else "\n"
+            if self.as_array and self.records:
+                self.stream.write(sep)
+            self.stream.write(sep.join(self.buffer))
+            if not self.as_array:
+                self.stream.write("\n")
+            self.records += len(self.buffer)
+            self.buffer = []
+
+    def commit(self):
+        ''' Scrive i record rimasti, chiude il file temporaneo e lo rinomina su path. '''
+        self.flush()
+        if self.as_array:
+            self.stream.write("]\n")
+        self.closeStream(sync=True)
+        os.chmod(self.tmp_path, self.targetMode())
+        os.replace(self.tmp_path, self.path)
+        return self.records
+
+    def abort(self):
+        self.buffer = []
+        self.closeStream()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def targetMode(self):
+        ''' Permessi del file finale: quelli del file esistente, altrimenti 0666 al netto della umask
+            (mkstemp crea il file temporaneo con 0600). '''
+        try:
+            return os.stat(self.path).st_mode & 0o7777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
+    def closeStream(self, sync=False):
+        if self.compress:
+            self.stream.close()
+        else:
+            self.stream.flush()
+            self.stream.detach()
+        if sync:
+            self.raw.flush()
+            os.fsync(self.raw.fileno())
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
 
 class DataQuality(object):
+    LOCAL_TZ_NAME = "Europe/Vienna"
+    timezones = {}
+    # metodi memoizzabili e dipendenze che ne invalidano la cache ("lookup": tabelle parametriche, "schema": schema json)
+    MEMOIZABLE = {
+        "standardizeDate": (),
+        "is_date": (),
+        "is_number": (),
+        "standardizeBoolValue": (),
+        "capitalizeFirstLetter": (),
+        "structuralStringErrorRepair": ("lookup", "schema")
+    }
+    MEMO_DEFAULT_SIZE = 10000
+    # regole applicabili ai campi (sezione "rules" della configurazione): metodo scalare -> versione per colonna
+    COLUMN_RULES = {
+        "standardizeDate": "standardizeDateMany",
+        "standardizeBoolValue": "standardizeBoolValueColumn",
+        "standardizeNumericFormat": "standardizeNumericFormatColumn",
+        "standardizeText": "standardizeTextColumn",
+        "specialChar": "specialCharMany",
+        "byAThousand": "byAThousandColumn",
+        "verifyTimeSlot": "verifyTimeSlotColumn"
+    }
+    # regole senza versione per colonna, applicate valore per valore (quelle in KEYED_RULES ricevono anche il campo)
+    VALUE_RULES = ("structuralStringErrorRepair", "capitalizeFirstLetter", "numericFormat", "toAscii")
+    KEYED_RULES = ("structuralStringErrorRepair",)
+    # regole eseguite da un metodo diverso da quello omonimo (toAscii: i valori non stringa restano invariati)
+    RULE_METHODS = {"toAscii": "normalizeValue"}
+    # metodi strumentati quando le metriche sono attive
+    METERED = ("jsonValidation", "validateMany", "validateBatch", "structuralStringErrorRepair", "specialChar", "specialCharMany",
+               "standardizeText", "standardizeTextMany", "defaultValues", "fillMandatoryFields", "standardizeDate", "standardizeDateMany",
+               "removeDuplicateJson", "decodingUnicodeJson", "decodingUnicodeJsonMany", "splitMultipleValues",
+               "standardizeNumericFormat", "standardizeNumericFormatColumn", "standardizeBoolValue", "standardizeBoolValueColumn",
+               "addingIngestionDate", "addModifyDate", "addRecordId", "iterUniqueJson", "applyRules", "iterApplyRules")
+    metrics = None
 
-    def __init__(self):
-        self.config = ScriptConfiguration()
+    def __init__(self, config=None):
+        ''' La connessione al db, la cache delle tabelle parametriche e l'allocatore degli identificativi vengono
+            creati al primo utilizzo (vedi le property dbClient, lookupCache e idAllocator): le esecuzioni che non
+            accedono al db non aprono connessioni. Se passata, config (ScriptConfiguration) viene riutilizzata. '''
+        self.config = config if config is not None else ScriptConfiguration()
         self.file_path = self.config.file_path_dest
         local_log = self.config.log_local_folder + "/" + self.config.log_filename
         #remote_log = self.config.log_remote_folder + "/" + self.config.log_filename
         log_lev = "DEBUG" if self.config.level_debug else "VERBOSE" if self.config.level_verbose else "INFO"
-        self.logger = Logger(class_name='', app_name=self.config.app_name, local_log_file=local_log, time_precision='second', log_level=log_lev) if local_log else None
-        self.logger.debug("init - local_log: '{}'".format(local_log))
+        self.logger = Logger(class_name='', app_name=self.config.app_name, local_log_file=local_log, time_precision='second', log_level=log_lev,
+            queue_size=self.config.log_queue_size, full_policy=self.config.log_queue_full_policy,
+            batch_size=self.config.log_queue_batch_size, compress_rotated=self.config.log_compress_rotated) if local_log else None
+        self.logger.debug("init - local_log: '%s'", local_log)
         #self.logger.debug("init - remote_log: '{}'".format(remote_log))
-        self.dbClient = self.config.getDbClient()
-        self.logger.info("Connection to db opened! Db url: jdbc:postgresql://{}:{}/{}".format(self.config.db_host, self.config.db_port, self.config.db_database))
+        self.validatorCache = dict()
+        self.memoCaches = dict()
+        self.normalizedKeys = dict()
+        self.rulePlans = dict()
+        if self.config.memoization_enabled:
+            self.enableMemoization(self.config.memoization_sizes)
+        if self.config.metrics_enabled:
+            self.enableMetrics()
+
+    @property
+    def LOCAL_TZ(self):
+        ''' Timezone locale, risolta una sola volta al primo utilizzo e condivisa tra le istanze. '''
+        tz = DataQuality.timezones.get(self.LOCAL_TZ_NAME)
+        if tz is None:
+            tz = DataQuality.timezones[self.LOCAL_TZ_NAME] = pytz.timezone(self.LOCAL_TZ_NAME)
+        return tz
+
+    @property
+    def dateParser(self):
+        ''' DateParser dell'istanza (i formati appresi non sono condivisi tra istanze), creato al primo utilizzo. '''
+        if getattr(self, "_dateParser", None) is None:
+            self._dateParser = DateParser()
+        return self._dateParser
+
+    @dateParser.setter
+    def dateParser(self, dateParser):
+        self._dateParser = dateParser
+
+    @property
+    def dbClient(self):
+        if getattr(self, "_dbClient", None) is None:
+            self._dbClient = self.config.getDbClient()
+            self.logger.info("Connection to db opened! Db url: jdbc:postgresql://{}:{}/{}".format(self.config.db_host, self.config.db_port, self.config.db_database))
+            if self.metrics is not None:
+                self.metrics.instrumentDb(self._dbClient)
+        return self._dbClient
+
+    @dbClient.setter
+    def dbClient(self, dbClient):
+        self._dbClient = dbClient
+
+    @property
+    def lookupCache(self):
+        if getattr(self, "_lookupCache", None) is None:
+            self.lookupCache = LookupTableCache(self.dbClient, self.config.db_schema, ttl=self.config.lookup_cache_ttl,
+                version_column=self.config.lookup_cache_version_column, logger=self.logger)
+        return self._lookupCache
+
+    @lookupCache.setter
+    def lookupCache(self, lookupCache):
+        self._lookupCache = lookupCache
+        if lookupCache is not None and getattr(self, "memoCaches", None):
+            lookupCache.addRefreshListener(self.onLookupRefresh)
+
+    @property
+    def idAllocator(self):
+        if getattr(self, "_idAllocator", None) is None:
+            self._idAllocator = RecordIdAllocator(self.dbClient, self.config.db_schema, self.config.get_id_function, self.config.app_name,
+                block_size=self.config.id_block_size, range_function=self.config.get_id_range_function)
+        return self._idAllocator
+
+    @idAllocator.setter
+    def idAllocator(self, idAllocator):
+        self._idAllocator = idAllocator
     
     ''' ##########################################################################
     ###                   DATA REFINEMENT                                      ###
     ########################################################################## '''
     
     
+    def getValidator(self, schema=None):
+        ''' Ritorna il validatore compilato per lo schema in input (path del file). Di default se non passato, lo schema
+            viene individuato dal file di configurazione: self.config.schema_path + "/" + self.config.schema_file.
+            Il validatore (insieme alla mappa dei default dei campi mandatori) viene messo in cache per path e mtime del file: lo schema viene riletto e ricontrollato
+            solo se il file cambia. '''
+        if schema is None:
+            schema = self.config.schema_path + "/" + self.config.schema_file
+        mtime = os.path.getmtime(schema)
+        cached = self.validatorCache.get(schema)
+        if cached is None or cached[0] != mtime:
+            self.logger.info("getValidator - caricamento schema '%s'", schema)
+            with open(schema) as schema_file:
+                json_schema = json.load(schema_file)
+            cls = jsonschemaValidators.validator_for(json_schema)
+            cls.check_schema(json_schema)
+            cached = (mtime, cls(json_schema), json_schema, self.buildDefaultMap(json_schema))
+            self.validatorCache[schema] = cached
+        if getattr(self, "default_map", None) is not cached[3]:
+            # schema ricaricato o cambio di schema attivo: i risultati memoizzati dipendono dai default del precedente
+            self.invalidateMemo("schema")
+        self.json_schema = cached[2]
+        self.default_map = cached[3]
+        return cached[1]
+
     def jsonValidation(self, json_file, schema=None):
         ''' Validazione del json_file secondo lo schema in input. Di default se non passato, lo schema viene individuato
             dal file di configurazione: self.config.schema_path + "/" + self.config.schema_file '''
         try:
-            if schema is None:
-                schema = self.config.schema_path + "/" + self.config.schema_file
-            self.logger.info("init - jsonValidation for '{}' with schemafile '{}' in path '{}'".format(self.config.app_name, self.config.schema_file, self.config.schema_path))
-            with open(schema) as schema:
-                self.json_schema = json.load(schema)
-            validate(json_file, self.json_schema)
+            self.logger.info("init - jsonValidation for '%s' with schemafile '%s' in path '%s'", self.config.app_name, self.config.schema_file, self.config.schema_path)
+            error = jsonschemaExceptions.best_match(self.getValidator(schema).iter_errors(json_file))
+            if error is not None:
+                raise error
             self.logger.info("END OK - jsonValidation")
-        except ValidationError as err:
+        except jsonschemaExceptions.ValidationError as err:
             self.logger.error("ValidationError - Error in validation json schema. Details: {}".format(str(err)))
-            raise ValidationError("ValidationError - Error in validation json schema. Details: {}".format(str(err)))
+            raise jsonschemaExceptions.ValidationError("ValidationError - Error in validation json schema. Details: {}".format(str(err)))
         except Exception as exc:
             self.logger.error("Generic error in validation json schema. Details: {}".format(str(exc)))
             raise Exception("Generic error in validation json schema. Details: {} and traceback: ".format(str(exc)))
+
+    def validateMany(self, records, schema=None):
+        ''' Validazione di una lista di record riutilizzando lo stesso validatore compilato per tutto il batch.
+            Come in validateBatch, se lo schema descrive un array ogni record viene validato come elemento dell'array.
+            Si interrompe al primo record non valido sollevando ValidationError con l'indice del record. '''
+        try:
+            self.logger.info("init - validateMany for '%s' with schemafile '%s' in path '%s'", self.config.app_name, self.config.schema_file, self.config.schema_path)
+            validator = self.getValidator(schema)
+            isArraySchema = validator.schema.get("type") == "array"
+            for i, record in enumerate(records):
+                error = jsonschemaExceptions.best_match(validator.iter_errors([record] if isArraySchema else record))
+                if error is not None:
+                    raise jsonschemaExceptions.ValidationError("record {}: {}".format(i, error.message))
+            self.logger.info("END OK - validateMany")
+        except jsonschemaExceptions.ValidationError as err:
+            self.logger.error("ValidationError - Error in validation json schema. Details: {}".format(str(err)))
+            raise jsonschemaExceptions.ValidationError("ValidationError - Error in validation json schema. Details: {}".format(str(err)))
+        except Exception as exc:
+            self.logger.error("Generic error in validation json schema. Details: {}".format(str(exc)))
+            raise Exception("Generic error in validation json schema. Details: {}".format(str(exc)))
             
     
+    def validateBatch(self, records, valid_output, quarantine_path, schema=None, max_errors=None):
+        ''' Validazione massiva e non bloccante di un iterabile di json (anche un generatore: i record vengono letti
+            uno alla volta). I record validi vengono scritti su valid_output (path di un file NDJSON oppure callable
+            che riceve il record), quelli non validi sul file NDJSON di quarantena insieme ai loro errori.
+            Per ogni record vengono raccolti al massimo max_errors errori (default da configurazione).
+            Se lo schema descrive un array, ogni record viene validato come elemento dell'array (items).
+            Ritorna i conteggi aggregati per tipo di errore e per campo.
+        '''
+        self.logger.info("validateBatch - INIT")
+        max_errors = max_errors if max_errors is not None else self.config.validation_max_errors
+        validator = self.getValidator(schema)
+        isArraySchema = validator.schema.get("type") == "array"
+        stats = {"total": 0, "valid": 0, "invalid": 0, "errors_by_type": {}, "errors_by_field": {}}
+        valid_file = None if callable(valid_output) else open(valid_output, "w")
+        try:
+            with open(quarantine_path, "w") as quarantine_file:
+                for record in records:
+                    stats["total"] += 1
+                    errors = list(islice(validator.iter_errors([record] if isArraySchema else record), max_errors + 1))
+                    if not errors:
+                        stats["valid"] += 1
+                        if valid_file is None:
+                            valid_output(record)
+                        else:
+                            valid_file.write(json.dumps(record, default=str) + "\n")
+                        continue
+                    stats["invalid"] += 1
+                    details = []
+                    for err in errors[:max_errors]:
+                        field = self.errorField(err, 1 if isArraySchema else 0)
+                        stats["errors_by_type"][err.validator] = stats["errors_by_type"].get(err.validator, 0) + 1
+                        stats["errors_by_field"][field] = stats["errors_by_field"].get(field, 0) + 1
+                        details.append({"field": field, "validator": err.validator, "message": err.message})
+                    quarantine_file.write(json.dumps({"record": record, "errors": details,
+                        "truncated": len(errors) > max_errors}, default=str) + "\n")
+        finally:
+            if valid_file is not None:
+                valid_file.close()
+        self.logger.info("validateBatch - END: {} record, {} validi, {} in quarantena".format(stats["total"], stats["valid"], stats["invalid"]))
+        return stats
+
+    def errorField(self, err, skip=0):
+        ''' Ritorna il path del campo a cui si riferisce un errore di validazione (es. 'Veicolo/Targa'), scartando
+            i primi skip elementi. Per gli errori 'required' viene aggiunto il nome del campo mancante. '''
+        path = [str(el) for el in list(err.absolute_path)[skip:]]
+        if err.validator == "required":
+            missing = [name for name in err.validator_value if repr(name) in err.message]
+            path.extend(missing[:1])
+        return "/".join(path) if path else "<root>"
+
     def capitalizeFirstLetter(self, value):
         ''' Se la prima lettera non e' maiuscola, restituisce il valore originario con la lettera maisucola. '''
         if (not value[0].isupper()):
@@ -63,14 +622,14 @@ class DataQuality(object):
         ''' Estrae l'anno da una stringa rappresentante una data (qualsiasi formato) e lo restituisce come intero.
         '''
         try: 
-            return parse(value, fuzzy=fuzzy).year
+            return self.dateParser.parse(value, fuzzy=fuzzy).year
         except ValueError as ve:
             self.logger.error("Error in extractYearFromEveryDate for field date value '{}'. Details: {}".format(value, str(ve)))
             
     def is_date(self, string, fuzzy = False):
         ''' Analizza una stringa e ritorna True se rappresenta una data (qualsiasi sia il formato), False altrimenti '''
         try:
-            parse(string, fuzzy=fuzzy)
+            self.dateParser.parse(string, fuzzy=fuzzy)
             return True
         except ValueError as ve:
             return False
@@ -80,21 +639,31 @@ class DataQuality(object):
         return int(value) * 1000
                 
             
-    def standardizeDate(self, string):
-        ''' Ritorna una data standardizzata in formato utc'''
+    def standardizeDate(self, string, fmt=None):
+        ''' Ritorna una data standardizzata in formato utc. fmt e' l'eventuale formato atteso (vedi DateParser).'''
         try:
             try:
-                date = parser.parse(string)
+                date = self.dateParser.parse(string, fmt)
             except:
                 return None
-            local = pytz.timezone("Europe/Vienna")
-            naive = datetime.strptime(date.strftime("%Y-%m-%dT%H:%M:%SZ"), "%Y-%m-%dT%H:%M:%SZ")
-            local_dt = local.localize(naive, is_dst=None)
-            utc_dt = local_dt.astimezone(pytz.utc)
-            return utc_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+            return self.toUtcString(date)
         except ValueError as ve:
             self.logger.error("Error in extractYearFromEveryDate for field date value '{}'. Details: {}".format(ve, str(ve)))
-            
+
+    def standardizeDateMany(self, values, sample_size=100):
+        ''' Versione massiva di standardizeDate per un'intera colonna: individua il formato prevalente su un campione
+            di sample_size valori e lo usa come fast path per tutta la lista. Ritorna la lista delle date in utc
+            (None per i valori non riconosciuti come date). '''
+        self.logger.info("standardizeDateMany - INIT")
+        values = values if isinstance(values, list) else list(values)
+        fmt = self.dateParser.infer(values, sample_size)
+        self.logger.debug("standardizeDateMany - formato prevalente: %s", fmt)
+        return [self.standardizeDate(value, fmt) for value in values]
+
+    def toUtcString(self, date):
+        ''' Interpreta un datetime naive come ora locale (Europe/Vienna) e lo ritorna come stringa utc. '''
+        local_dt = self.LOCAL_TZ.localize(date.replace(microsecond=0), is_dst=None)
+        return local_dt.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
             
             
     def is_number(self, string):
@@ -112,11 +681,26 @@ class DataQuality(object):
         ''' Metodo utilizzato per chiudere la connessione al db se aperta prima di terminare l'esecuzione dello script
             e per copiare il log in hdfs. '''
         try:
-            self.dbClient.close()
-            self.logger.info("Connection to db closed!")
+            dbClient = getattr(self, "_dbClient", None)
+            if dbClient is not None:
+                dbClient.close()
+                self.logger.info("Connection to db closed!")
+                if getattr(dbClient, "prepared_cache_size", 0):
+                    self.logger.info("Prepared statement stats: {}".format(dbClient.getPreparedStats()))
+            if getattr(self, "_lookupCache", None) is not None:
+                self.logger.info("Lookup cache stats: {}".format(self.lookupCache.getStats()))
+            if getattr(self, "_idAllocator", None) is not None:
+                self.logger.info("Record id stats: {}".format(self.idAllocator.getStats()))
+            if self.memoCaches:
+                self.logger.info("Memoization stats: {}".format(self.getMemoStats()))
+            if self.metrics is not None:
+                self.dumpMetrics()
             
             className = className if className else self.config.app_name
             self.logger.info("{} END".format(className))
+            if self.logger.getDroppedCount():
+                self.logger.warning("Log records dropped (queue full): {}".format(self.logger.getDroppedCount()))
+            self.logger.flush()
             #log_local_path = self.config.log_local_folder + "/" + self.config.log_filename
             #self.config.copyLogHdfs(self.config.log_remote_folder, log_local_path)
         except Exception as exc:
@@ -134,94 +718,346 @@ class DataQuality(object):
             (punto 'Errori strutturali').
         '''
         try:
-            self.logger.info("Inizio esamina stringa. Stringa ricevuta: '{}'".format(string))
+            self.logger.info("Inizio esamina stringa. Stringa ricevuta: '%s'", string)
             if string != '':
-                strng = self.specialChar(string) if self.specialChar(string) else string
-                strng = self.standardizeText(strng) if self.standardizeText(strng) else strng
+                strng = self.specialChar(string) or string
+                strng = self.standardizeText(strng) or strng
                 string_to_return = ' '.join(strng.split()).title()
                 return string_to_return
             else:
-                return self.defaultValues(key) if self.defaultValues(key) else "Null"
+                return self.defaultValues(key) or "Null"
         except Exception as exc:
             self.logger.error("Error while repairing structural error in string value '{}'. Details: {}".format(string, str(exc)))
  
     def standardizeText(self, string):
         ''' Effettua le operazioni di standardizzazione del testo richieste e ritorna la stringa modificata. 
-            In particolare, per farlo viene utilizzata una tabella presente sul db postgresql.
+            In particolare, per farlo viene utilizzata una tabella presente sul db postgresql, indicizzata in memoria
+            tramite buildStandardizeIndex (una sola ricerca in dizionario per stringa).
         '''
         try:
             self.logger.info("Inizio standardizzazione stringa.")
-            res = self.dbClient.executeQuery("SELECT * from {}.{}".format(self.config.db_schema, self.config.string_poss_table), isSelect=True)
-            for record in res:
-                for el in record[0]:
-                    #self.logger.debug("el {}".format(el))
-                    if string.upper() == el:
-                        self.logger.debug("String value found in standard table. Replacing it with: '{}'".format(record[1]))
-                        return record[1]
+            index = self.lookupCache.getDerived(self.config.string_poss_table, "standardize_index", self.buildStandardizeIndex)
+            standard = index.get(string.upper())
+            if standard is not None:
+                self.logger.debug("String value found in standard table. Replacing it with: '%s'", standard)
+            return standard
         except Exception as exc:
             self.logger.error("Error while trying to standardize text '{}'. Details: {}".format(string, str(exc)))
             raise Exception("Error while trying to standardize text '{}'. Details: {}".format(string, str(exc)))
-            
+
+    def standardizeTextMany(self, values):
+        ''' Versione massiva di standardizeText per un'intera colonna: ritorna una lista con, per ogni valore in input,
+            il valore standard trovato in tabella oppure None (anche per i valori non stringa).
+        '''
+        try:
+            self.logger.info("standardizeTextMany - INIT")
+            index = self.lookupCache.getDerived(self.config.string_poss_table, "standardize_index", self.buildStandardizeIndex)
+            return [index.get(value.upper()) if isinstance(value, str) else None for value in values]
+        except Exception as exc:
+            self.logger.error("standardizeTextMany - ERROR: {}".format(str(exc)))
+            raise Exception("Error while trying to standardize text column. Details: {}".format(str(exc)))
+
+    def standardizeTextColumn(self, values):
+        ''' Versione di standardizeTextMany usata dalle regole di campo: come in structuralStringErrorRepair, i valori
+            non presenti in tabella (e quelli non stringa) restano invariati invece di diventare None. '''
+        return [std if std is not None else value for value, std in zip(values, self.standardizeTextMany(values))]
+
+    def buildStandardizeIndex(self, rows):
+        ''' Costruisce l'indice inverso {variante: valore standard} a partire dalle righe di string_poss_table
+            (array di varianti, valore standard). A parita' di variante vince la prima riga della tabella, come
+            nella scansione sequenziale originaria.
+        '''
+        index = dict()
+        for record in rows:
+            for el in record[0] or ():
+                if el not in index:
+                    index[el] = record[1]
+        return index
+
     def specialChar(self, string):
         ''' Individua e sostituisce/rimuove i caratteri speciali tramite tabella parametrica e ritorna la stringa modificata. 
-            In particolare, per farlo viene utilizzata una tabella presente sul db postgresql.
+            In particolare, per farlo viene utilizzata una tabella presente sul db postgresql, compilata una sola volta
+            in un SpecialCharReplacer.
         '''
         try:
             self.logger.info("Inizio ricerca caratteri speciali")
-            res = self.dbClient.executeQuery("SELECT * from {}.{}".format(self.config.db_schema, self.config.special_char_table), isSelect=True)
-            #self.logger.debug("res: {}".format(res))
-            for record in res:
-                if record[0] in string:
-                    self.logger.debug("Trovato carattere speciale: {}".format(record[0]))
-                    string = string.replace(record[0], record[1]) if record[1] else string.replace(record[0], "")
+            replacer = self.lookupCache.getDerived(self.config.special_char_table, "special_char_replacer", SpecialCharReplacer)
+            string = replacer.replace(string)
         except UnicodeDecodeError as ude:
             self.logger.warning("UnicodeDecodeError: {}".format(str(ude)))
-            for record in res:
-                if record[0] in string.decode('utf-8'):
-                    self.logger.debug("Trovato carattere speciale: {}".format(record[0]))
-                    string = string.decode('utf-8').replace(record[0], record[1]) if record[1] else string.decode('utf-8').replace(record[0], "")
         finally:
-            self.logger.debug("return_value: {}".format(string))
+            self.logger.debug("return_value: %s", string)
             return string
-            
+
+    def specialCharMany(self, strings):
+        ''' Versione massiva di specialChar: ritorna la lista delle stringhe in input con i caratteri speciali
+            sostituiti/rimossi. I valori non decodificabili vengono restituiti invariati. '''
+        self.logger.info("specialCharMany - INIT")
+        replacer = self.lookupCache.getDerived(self.config.special_char_table, "special_char_replacer", SpecialCharReplacer)
+        try:
+            return replacer.replaceMany(strings)
+        except UnicodeDecodeError as ude:
+            self.logger.warning("UnicodeDecodeError: {}".format(str(ude)))
+            return [self.specialChar(string) for string in strings]
+
+    def enableMemoization(self, sizes=None):
+        ''' Attiva la memoizzazione (cache LRU) dei metodi di trasformazione puri elencati in MEMOIZABLE.
+            sizes e' un dizionario {metodo: dimensione massima}; se None vengono memoizzati tutti i metodi con
+            dimensione MEMO_DEFAULT_SIZE. Le cache dei metodi che dipendono dalle tabelle parametriche o dallo
+            schema vengono svuotate al refresh di queste ultime. '''
+        sizes = sizes if sizes else dict((name, self.MEMO_DEFAULT_SIZE) for name in self.MEMOIZABLE)
+        # il listener viene registrato qui solo se la cache esiste gia', altrimenti alla sua creazione (lookupCache):
+        # la memoizzazione non apre la connessione al db
+        if not self.memoCaches and getattr(self, "_lookupCache", None) is not None:
+            self._lookupCache.addRefreshListener(self.onLookupRefresh)
+        for name, size in sizes.items():
+            if name not in self.MEMOIZABLE:
+                self.logger.warning("enableMemoization - metodo '{}' non memoizzabile".format(name))
+                continue
+            if name not in self.memoCaches:
+                self.memoCaches[name] = LruCache(size)
+                setattr(self, name, self.memoize(getattr(self, name), self.memoCaches[name], "lookup" in self.MEMOIZABLE[name]))
+        self.logger.info("enableMemoization - metodi memoizzati: {}".format(sorted(self.memoCaches.keys())))
+
+    def onLookupRefresh(self, table_name):
+        self.invalidateMemo("lookup")
+
+    def memoize(self, method, cache, checkLookup=False):
+        ''' Ritorna il metodo avvolto dalla cache. La chiave comprende il tipo degli argomenti (1 e True sono distinti);
+            con argomenti non hashable il metodo viene invocato direttamente. Se checkLookup e' True, prima di ogni
+            accesso viene verificata la validita' delle tabelle parametriche (eventuale refresh e invalidazione). '''
+        def wrapper(*args, **kwargs):
+            if checkLookup:
+                self.lookupCache.get(self.config.special_char_table)
+                self.lookupCache.get(self.config.string_poss_table)
+            try:
+                key = (tuple((type(arg), arg) for arg in args), tuple(sorted(kwargs.items())))
+                value = cache.get(key)
+            except TypeError:
+                return method(*args, **kwargs)
+            if value is LruCache.MISSING:
+                value = method(*args, **kwargs)
+                cache.put(key, value)
+            return value
+        return wrapper
+
+    def invalidateMemo(self, dependency):
+        ''' Svuota le cache dei metodi memoizzati che dipendono da dependency ("lookup" o "schema"). '''
+        for name, cache in getattr(self, "memoCaches", {}).items():
+            if dependency in self.MEMOIZABLE[name]:
+                cache.clear()
+
+    def getMemoStats(self):
+        ''' Ritorna le statistiche (dimensione, hit/miss, hit rate, ...) delle cache dei metodi memoizzati. '''
+        return dict((name, cache.getStats()) for name, cache in self.memoCaches.items())
+
+    def enableMetrics(self):
+        ''' Attiva la raccolta delle metriche (chiamate, latenze, record al secondo) sui metodi METERED e sulle
+            query eseguite dal client db. '''
+        if self.metrics is None:
+            self.metrics = Metrics()
+            self.metrics.instrument(self, self.METERED)
+            if getattr(self, "_dbClient", None) is not None:
+                self.metrics.instrumentDb(self._dbClient)
+            self.logger.info("enableMetrics - metriche attive")
+
+    def dumpMetrics(self, json_path=None, prometheus_path=None):
+        ''' Scrive le metriche raccolte in json e in formato testuale Prometheus (default da configurazione). '''
+        try:
+            json_path = json_path if json_path else self.config.metrics_json_path
+            prometheus_path = prometheus_path if prometheus_path else self.config.metrics_prometheus_path
+            if json_path:
+                self.metrics.dumpJson(json_path)
+            if prometheus_path:
+                self.metrics.dumpPrometheus(prometheus_path)
+            self.logger.info("dumpMetrics - metriche scritte in '%s' e '%s'", json_path, prometheus_path)
+        except Exception as exc:
+            self.logger.error("dumpMetrics - ERROR: {}".format(str(exc)))
+
+    def preloadLookupTables(self):
+        ''' Carica in memoria le tabelle parametriche usate da specialChar e standardizeText, cosi' che le
+            chiamate successive non effettuino round-trip verso il db. '''
+        self.lookupCache.get(self.config.special_char_table)
+        self.lookupCache.get(self.config.string_poss_table)
+        self.logger.info("preloadLookupTables - tabelle caricate: {}".format(self.lookupCache.getStats()["tables"]))
+
+    def getLookupStats(self):
+        ''' Ritorna i contatori hit/miss/refresh della cache delle tabelle parametriche. '''
+        return self.lookupCache.getStats()
+
+    def readRecords(self, path, format=None):
+        ''' Ritorna un generatore dei record letti in streaming da path (NDJSON o array json, anche gzip). '''
+        self.logger.info("readRecords - lettura di '%s'", path)
+        return iter(JsonRecordReader(path, format=format))
+
+    def openRecordWriter(self, path=None, batch_size=None, as_array=False):
+        ''' Ritorna un JsonRecordWriter su path (default file_path_dest da configurazione): i record vengono scritti a
+            blocchi di batch_size (default app.write_batch_size) e il file compare su path solo al commit. '''
+        path = path if path is not None else self.file_path
+        batch_size = batch_size if batch_size is not None else self.config.write_batch_size
+        self.logger.info("openRecordWriter - scrittura su '%s'", path)
+        return JsonRecordWriter(path, batch_size=batch_size, as_array=as_array)
+
+    def compileRules(self, schema=None):
+        ''' Compila le regole della configurazione per lo schema (default schema_file) in un piano di esecuzione:
+            una lista di (campo, funzione) in cui ogni funzione trasforma l'intera colonna del campo.
+            La sezione "rules" e' nella forma {schema: {campo: [regola, ...]}} dove una regola e' il nome di un metodo
+            (es. "standardizeDate") oppure {"method": nome, "args": {...}}. Le regole con versione per colonna
+            (COLUMN_RULES) usano quella; le regole consecutive valore per valore vengono fuse in un'unica passata.
+            Il piano viene messo in cache per schema.
+        '''
+        schema = schema if schema else self.config.schema_file
+        plan = self.rulePlans.get(schema)
+        if plan is None:
+            rules = self.config.rules.get(schema, {})
+            plan = [(field, self.compileFieldRules(field, specs if isinstance(specs, list) else [specs]))
+                    for field, specs in rules.items()]
+            self.rulePlans[schema] = plan
+            self.logger.info("compileRules - piano per '%s': %s campi", schema, len(plan))
+        return plan
+
+    def compileFieldRules(self, field, specs):
+        steps = []
+        pending = []
+        for spec in specs:
+            name, args = (spec, {}) if isinstance(spec, basestring) else (spec["method"], spec.get("args", {}))
+            if name in self.COLUMN_RULES:
+                if pending:
+                    steps.append(self.fuseValueRules(pending))
+                    pending = []
+                method = getattr(self, self.COLUMN_RULES[name])
+                steps.append(lambda values, method=method, args=args: method(values, **args))
+            elif name in self.VALUE_RULES:
+                method = getattr(self, self.RULE_METHODS.get(name, name))
+                if name in self.KEYED_RULES:
+                    pending.append(lambda value, method=method, args=args: method(field, value, **args))
+                else:
+                    pending.append(lambda value, method=method, args=args: method(value, **args))
+            else:
+                raise ValueError("compileRules - regola '{}' non supportata per il campo '{}'".format(name, field))
+        if pending:
+            steps.append(self.fuseValueRules(pending))
+        if len(steps) == 1:
+            return steps[0]
+
+        def column(values):
+            for step in steps:
+                values = step(values)
+            return values
+        return column
+
+    def fuseValueRules(self, rules):
+        ''' Fonde una sequenza di regole valore per valore in un'unica passata sulla colonna. '''
+        def column(values):
+            result = []
+            for value in values:
+                for rule in rules:
+                    value = rule(value)
+                result.append(value)
+            return result
+        return column
+
+    def applyRules(self, records, schema=None):
+        ''' Applica il piano compilato delle regole ad una lista di record, campo per campo sull'intera colonna.
+            I campi assenti in un record non vengono aggiunti. Ritorna la lista dei record modificati. '''
+        records = records if isinstance(records, list) else list(records)
+        for field, column in self.compileRules(schema):
+            present = [record for record in records if field in record]
+            if present:
+                for record, value in zip(present, column([record[field] for record in present])):
+                    record[field] = value
+        return records
+
+    def iterApplyRules(self, records, batch_size=None, schema=None):
+        ''' Versione in streaming di applyRules: i record (anche un generatore) vengono elaborati a blocchi di batch_size. '''
+        batch_size = batch_size if batch_size else self.config.write_batch_size
+        records = iter(records)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return
+            for record in self.applyRules(batch, schema):
+                yield record
+
     def defaultValues(self, key, schema=None):
         ''' Imposta i valori di default per i campi mandatori che vengono ricevuti nulli. In particolare:
             - campo stringa - valore di default '--'
             - campo data - valore di default '01-01-0001'
             - campo numerico - valore di default -1
+            Il valore viene letto dalla mappa {campo: default} compilata al caricamento dello schema (buildDefaultMap);
+            se schema (path del file) e' passato, viene usata la mappa di quello schema.
             Per maggiori informazioni, verificare la sezione 6.2.2 dell'Allegato D - Componenti di Sistema 
             (punto 'Errori strutturali').
         '''
         try:
             self.logger.info("defaultValues - INIT")
-            requiredFields = self.config.getJsonValue(self.json_schema, None, "required") if self.config.getJsonValue(self.json_schema, None, "required") \
-                else self.config.getJsonValue(self.json_schema, None, "items", "required")
-            for i in range(len(requiredFields)):
-                if requiredFields[i] == key:
-                    type = self.config.getJsonValue(self.json_schema, None,"items","properties", key, "type")
-                    if type == "string":
-                        return self.config.defaultValue_string
-                    elif type == "date":
-                        return self.config.defaultValue_date
-                    else:
-                        return self.config.defaultValue_number
-                else:
-                    continue
+            if schema is not None:
+                self.getValidator(schema)
+            return self.default_map.get(key)
         except Exception as e:
             self.logger.error("defaultValues - ERROR: {}".format(str(e)))
+
+    def buildDefaultMap(self, json_schema):
+        ''' Compila la mappa {campo mandatorio: valore di default} a partire dallo schema json, sia nel caso di schema
+            di oggetto (required/properties di primo livello) sia nel caso di schema di array (items). '''
+        requiredFields = self.config.getJsonValue(json_schema, None, "required") if self.config.getJsonValue(json_schema, None, "required") \
+            else self.config.getJsonValue(json_schema, [], "items", "required")
+        default_map = dict()
+        for key in requiredFields:
+            type = self.config.getJsonValue(json_schema, None, "properties", key, "type") \
+                or self.config.getJsonValue(json_schema, None, "items", "properties", key, "type")
+            if type == "string":
+                default_map[key] = self.config.defaultValue_string
+            elif type == "date":
+                default_map[key] = self.config.defaultValue_date
+            else:
+                default_map[key] = self.config.defaultValue_number
+        return default_map
+
+    def fillMandatoryFields(self, json_in, isList=False):
+        ''' Valorizza con il default i campi mandatori mancanti, nulli o vuoti di un json (o di una lista di json se
+            isList e' True) e ritorna il json modificato. '''
+        try:
+            self.logger.info("fillMandatoryFields - INIT")
+            default_items = [(k, v) for k, v in self.default_map.items() if v is not None]
+            for json_obj in (json_in if isList else [json_in]):
+                for key, default in default_items:
+                    if json_obj.get(key) is None or json_obj.get(key) == "":
+                        json_obj[key] = default
+            return json_in
+        except Exception as e:
+            self.logger.error("fillMandatoryFields - ERROR: {}".format(str(e)))
     
     def removeDuplicateJson(self, json_list):
         ''' Rimuove json duplicati all'interno di una lista di json e ritorna la lista pulita
         '''
         try:
             self.logger.info("removeDuplicateJson - INIT")
-            seen = []
-            for json_el in json_list:
-                if json_el not in seen:
-                    seen.append(json_el)
+            seen = list(self.iterUniqueJson(json_list))
             return seen if seen else json_list
         except Exception as exc:
             self.logger.error("removeDuplicateJson - ERROR {}".format(str(exc)))
+
+    def iterUniqueJson(self, json_iter, unordered_lists=False, max_memory=None):
+        ''' Generatore che restituisce i json di json_iter scartando i duplicati, in un'unica passata e mantenendo
+            l'ordine di prima occorrenza. I duplicati sono individuati tramite jsonFingerprint; oltre max_memory
+            fingerprint (default da configurazione) l'insieme dei fingerprint viene riversato su disco.
+        '''
+        max_memory = max_memory if max_memory is not None else self.config.dedup_max_memory_fingerprints
+        fingerprints = FingerprintSet(max_memory)
+        try:
+            for json_el in json_iter:
+                if fingerprints.add(self.jsonFingerprint(json_el, unordered_lists)):
+                    yield json_el
+        finally:
+            fingerprints.close()
+
+    def jsonFingerprint(self, json_el, unordered_lists=False):
+        ''' Calcola un fingerprint stabile (sha1) di un json serializzandolo con le chiavi ordinate. Se unordered_lists
+            e' True il json viene prima normalizzato con ordered(), cosi' che liste con gli stessi elementi in ordine
+            diverso producano lo stesso fingerprint. '''
+        canonical = self.ordered(json_el) if unordered_lists else json_el
+        return hashlib.sha1(json.dumps(canonical, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).digest()
     
     def ordered(self, obj):
         ''' Ordina qualsiasi tipo di lista e converte i dizionari in liste di chiave,valore cosi da ordinarli.
@@ -245,7 +1081,7 @@ class DataQuality(object):
             - la stringa 'Null' se la fascia non e' corente.'''
         try:
             timeSlots = timeSlotString.split(char)
-            self.logger.info("timeSlots - {}".format(timeSlots))
+            self.logger.info("timeSlots - %s", timeSlots)
             flag = False
             for time in timeSlots:
                 if int(time) in range (1, 24):
@@ -264,21 +1100,21 @@ class DataQuality(object):
             Restituisce una stringa e se il parametro comma e' True (default) viene sostituito il punto con la virgola.'''
         try:
             self.logger.info("standardizeNumericFormat - INIT")
-            if not isinstance(numeric, str) and not isinstance(numeric, unicode):
-                self.logger.debug("type not string - {} is type {}".format(numeric, type(numeric)))
+            if not isinstance(numeric, basestring):
+                self.logger.debug("type not string - %s is type %s", numeric, type(numeric))
                 rounded_value = format(round(numeric), '.2f')
-                self.logger.debug("rounded_value pre comma- {}".format(rounded_value))
+                self.logger.debug("rounded_value pre comma- %s", rounded_value)
                 if comma:
                     self.logger.debug("comma")
                     rounded_value = rounded_value.replace('.',',')
-                self.logger.debug("rounded_value - {}".format(rounded_value))
+                self.logger.debug("rounded_value - %s", rounded_value)
                 return rounded_value
             else:
                 self.logger.debug("type string")
                 rounded_value = format(round(float(numeric)), '.2f')
                 if comma:
                     rounded_value = rounded_value.replace('.',',')
-                self.logger.debug("rounded_value - {}".format(rounded_value))
+                self.logger.debug("rounded_value - %s", rounded_value)
                 return rounded_value
         except Exception as exc:
             self.logger.error("standardizeNumericFormat - ERROR {}".format(str(exc)))
@@ -297,81 +1133,213 @@ class DataQuality(object):
         except Exception as exc:
             self.logger.error("standardizeBoolValue - ERROR {}".format(str(exc)))
         
+    ##########################################################################
+    # Versioni per colonna (liste di valori) dei metodi scalari: stessi risultati, senza il costo per chiamata
+    # di try/except e log. Se numpy e' disponibile le conversioni e gli arrotondamenti sono vettoriali.
+
+    def numericColumn(self, values):
+        ''' Converte una colonna di valori in float64 con la stessa semantica di float(). Ritorna la lista dei valori,
+            l'array dei float, la maschera dei valori convertibili e la maschera dei valori numerici non stringa. '''
+        values = values if isinstance(values, list) else list(values)
+        n = len(values)
+        isNum = np.fromiter((isinstance(v, Number) and not isinstance(v, complex) for v in values), dtype=bool, count=n)
+        isNone = np.fromiter((v is None for v in values), dtype=bool, count=n)
+        try:
+            floats = np.array(values, dtype=np.float64)
+            if floats.shape != (n,):
+                raise ValueError("colonna non monodimensionale")
+            valid = ~isNone
+        except (ValueError, TypeError):
+            floats = np.zeros(n)
+            valid = np.zeros(n, dtype=bool)
+            for i, v in enumerate(values):
+                try:
+                    floats[i] = float(v)
+                    valid[i] = True
+                except (ValueError, TypeError):
+                    pass
+        return values, floats, valid, isNum
+
+    def isNumberColumn(self, values):
+        ''' Versione per colonna di is_number: ritorna una lista di booleani (False anche per None e per i valori
+            non convertibili, per cui is_number solleva TypeError). '''
+        if not np.available():
+            return [self.is_number(v) if isinstance(v, (basestring, bytes, Number)) else False for v in values]
+        values, floats, valid, isNum = self.numericColumn(values)
+        isBool = np.fromiter((isinstance(v, bool) for v in values), dtype=bool, count=len(values))
+        return (valid & ~isBool).tolist()
+
+    def standardizeNumericFormatColumn(self, values, comma=True):
+        ''' Versione per colonna di standardizeNumericFormat: ritorna la lista delle stringhe arrotondate
+            (None per i valori non convertibili o non finiti). '''
+        if not np.available():
+            return [self.numericFormat(v, comma) for v in values]
+        values, floats, valid, isNum = self.numericColumn(values)
+        isStr = np.fromiter((isinstance(v, basestring) for v in values), dtype=bool, count=len(values))
+        ok = valid & (isStr | isNum) & np.isfinite(floats)
+        # np.rint arrotonda half-to-even come round(); + 0.0 evita il '-0.00'
+        formatted = np.char.mod('%.2f', np.rint(floats[ok]) + 0.0)
+        if comma:
+            formatted = np.char.replace(formatted, '.', ',')
+        result = [None] * len(values)
+        for i, value in zip(np.flatnonzero(ok).tolist(), formatted.tolist()):
+            result[i] = value
+        # gli interi oltre 2**53 non sono rappresentabili esattamente in float64
+        for i in np.flatnonzero(ok & isNum & (np.abs(floats) > 2 ** 53)).tolist():
+            result[i] = self.numericFormat(values[i], comma)
+        return result
+
+    def numericFormat(self, numeric, comma=True):
+        ''' Formattazione di standardizeNumericFormat senza log; ritorna None se il valore non e' convertibile. '''
+        try:
+            rounded_value = format(round(float(numeric) if isinstance(numeric, basestring) else numeric), '.2f')
+            return rounded_value.replace('.', ',') if comma else rounded_value
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    def byAThousandColumn(self, values):
+        ''' Versione per colonna di byAThousand: ritorna la lista dei valori moltiplicati per 1000. Come il metodo
+            scalare solleva un'eccezione se un valore non e' convertibile in intero. '''
+        values = values if isinstance(values, list) else list(values)
+        if np.available() and values:
+            try:
+                array = np.array(values)
+            except (ValueError, TypeError):
+                array = None
+            if array is not None and array.ndim == 1 and array.dtype.kind in 'iubf' and np.all(np.isfinite(array)) \
+                    and np.max(np.abs(array)) < 2 ** 53 / 1000:
+                return (np.trunc(array).astype(np.int64) * 1000).tolist()
+        return [int(v) * 1000 for v in values]
+
+    def verifyTimeSlotColumn(self, values, char):
+        ''' Versione per colonna di verifyTimeSlot: per ogni fascia ritorna il valore originale, 'Null' oppure None
+            se la fascia non e' interpretabile. '''
+        result = []
+        for timeSlotString in values:
+            try:
+                timeSlots = [int(time) for time in timeSlotString.split(char)]
+                result.append(timeSlotString if 1 <= timeSlots[-1] <= 23 else 'Null')
+            except Exception:
+                result.append(None)
+        return result
+
+    def standardizeBoolValueColumn(self, values):
+        ''' Versione per colonna di standardizeBoolValue: ritorna una lista di 'Si'/'No'/'Null'. '''
+        true_values = self.config.getJsonValue(self.config.cfg, None, "booleanValues", "true_values")
+        false_values = self.config.getJsonValue(self.config.cfg, None, "booleanValues", "false_values")
+        try:
+            true_values, false_values = set(true_values), set(false_values)
+        except TypeError:
+            pass
+        result = []
+        for boolValue in values:
+            try:
+                result.append('Si' if boolValue in true_values else 'No' if boolValue in false_values else 'Null')
+            except TypeError:
+                result.append(self.standardizeBoolValue(boolValue))
+        return result
+
     def decodingUnicodeJson(self, unicodeJsonObject):
+        ''' Normalizza in ascii (NFKD, scartando i caratteri non rappresentabili) chiavi e valori stringa di un json.
+            Le chiavi normalizzate vengono messe in cache e le stringhe gia' ascii non vengono rielaborate. '''
         self.logger.info("decodingUnicodeJson - INIT")
         json_dict = dict()
-        for k in unicodeJsonObject.keys():
-            self.logger.debug("input key {}".format(k))
+        for k, v in unicodeJsonObject.items():
             try:
-                new_key = unicodedata.normalize('NFKD', k).encode('ascii','ignore')
-                json_dict[new_key] = unicodeJsonObject[k]
+                json_dict[self.normalizeKey(k)] = self.normalizeValue(v)
             except TypeError as te:
                 self.logger.warning("TypeError: {}. Real type = {}".format(str(te), type(k)))
                 continue
             except Exception as exc:
                 self.logger.error("decodingUnicodeJson - ERROR {}".format(str(exc)))
-        for k, v in json_dict.items():
-            #self.logger.debug("input value {}".format(v))
-            try:
-                if not isinstance(v, bool):
-                    new_value = unicodedata.normalize('NFKD', v).encode('ascii','ignore')
-                    json_dict[k] = new_value
-            except TypeError as te:
-                self.logger.warning("TypeError: {}. Real type = {}. Value error key = {}".format(str(te), type(v), k))
-                continue
-            except Exception as exc:
-                self.logger.error("decodingUnicodeJson - ERROR {}".format(str(exc)))
-        self.logger.debug("output json {}".format(json.dumps(json_dict, indent=4)))
+        self.logger.debug("output json %s", json_dict)
         self.logger.info("decodingUnicodeJson - END")
         return json_dict if json_dict else unicodeJsonObject
+
+    def decodingUnicodeJsonMany(self, unicodeJsonObjects):
+        ''' Versione massiva di decodingUnicodeJson per una lista di json: la mappatura delle chiavi viene calcolata
+            una sola volta per ogni insieme distinto di chiavi. '''
+        self.logger.info("decodingUnicodeJsonMany - INIT")
+        keyMappings = dict()
+        result = []
+        for unicodeJsonObject in unicodeJsonObjects:
+            keys = tuple(unicodeJsonObject.keys())
+            mapping = keyMappings.get(keys)
+            if mapping is None:
+                mapping = []
+                for k in keys:
+                    try:
+                        mapping.append((k, self.normalizeKey(k)))
+                    except TypeError as te:
+                        self.logger.warning("TypeError: {}. Real type = {}".format(str(te), type(k)))
+                keyMappings[keys] = mapping
+            json_dict = dict((new_key, self.normalizeValue(unicodeJsonObject[k])) for k, new_key in mapping)
+            result.append(json_dict if json_dict else unicodeJsonObject)
+        self.logger.info("decodingUnicodeJsonMany - END: {} json, {} insiemi di chiavi distinti".format(len(result), len(keyMappings)))
+        return result
+
+    def normalizeKey(self, key):
+        ''' Normalizzazione ascii di una chiave, con cache. Solleva TypeError se la chiave non e' una stringa. '''
+        if not isinstance(key, basestring):
+            raise TypeError("chiave non stringa: {!r}".format(key))
+        new_key = self.normalizedKeys.get(key)
+        if new_key is None:
+            new_key = self.toAscii(key)
+            self.normalizedKeys[key] = new_key
+        return new_key
+
+    def normalizeValue(self, value):
+        ''' Normalizzazione ascii di un valore: i valori non stringa vengono restituiti invariati. '''
+        return self.toAscii(value) if isinstance(value, basestring) else value
+
+    def toAscii(self, string):
+        if string.isascii():
+            return string
+        return unicodedata.normalize('NFKD', string).encode('ascii', 'ignore').decode('ascii')
         
     
     ##########################################################################
-    def splitMultipleValues(self, json_in):
+    def splitMultipleValues(self, json_in, mode="single", max_fanout=None):
         ''' Individua la presenza di valori multipli in un unico campo testuale e li splitta in campi distinti.
-            Per farlo, cambia la struttura dell'oggetto json originale, per questo motivo restituisce un nuovo json.
+            Per farlo, cambia la struttura dell'oggetto json originale, per questo motivo restituisce una lista di
+            nuovi json (vedi iterSplitMultipleValues per i parametri).
         '''
         try:
             self.logger.info("splitMultipleValues - INIT")
-            list_of_key = []
-            list_of_value = []
-            list_of_k_v = []
-            for key, value in json_in.items():
-                if (isinstance(value, basestring) and value[0].isalpha()) and ',' in value:
-                    self.logger.debug("Sono presenti valori multipli in '{}'".format(value))
-                    values = value.split(',')
-                    list_of_k_v.append((key, values))
-                    list_of_key.append(key)
-                    self.logger.debug("list_of_k_v = {}".format(list_of_k_v))
-                    self.logger.debug("list_of_key = {}".format(list_of_key))
-                else:
-                    continue
-            
-            num_key = 0
-            num_values = 0
-            for i, tuple in enumerate(list_of_k_v):
-                v = tuple[1]
-                k = tuple[0]
-                self.logger.debug("key == {}, value == {}, len(v) == {}".format(k, v, len(v)))
-                num_key += i
-                num_values += len(v)
-            self.logger.debug("num_key == {}; num_values == {}".format(num_key, num_values))
-            
-            json_list = []
-            for k in range(len(list_of_key)):
-                for n in range(len(list_of_k_v)):
-                    if list_of_key[k] == list_of_k_v[n][0]:
-                        self.logger.debug("list_of_key[k] == {}; list_of_k_v[n][0] == {}".format(list_of_key[k], list_of_k_v[n][0]))
-                        json_copy = deepcopy(json_in)
-                        self.logger.debug("json_copy in == {}".format(json_copy))
-                        for x in range(len(list_of_k_v[n][1])):
-                            self.logger.debug("list_of_k_v[n][1][x] == {}".format(list_of_k_v[n][1][x]))
-                            json_copy[list_of_key[k]] = list_of_k_v[n][1][x]
-                            json_list.append(json_copy)
-            self.logger.debug("json_list == {}".format(json_list))
+            return list(self.iterSplitMultipleValues(json_in, mode, max_fanout))
         except Exception as e:
             self.logger.error("splitMultipleValues - ERROR: {}".format(str(e)))
             raise
+
+    def iterSplitMultipleValues(self, json_in, mode="single", max_fanout=None):
+        ''' Generatore dei json ottenuti splittando i campi testuali con valori multipli separati da virgola.
+            - mode "single": un campo alla volta, un json per ogni valore di ogni campo multiplo (gli altri campi
+              restano invariati);
+            - mode "product": prodotto cartesiano dei valori di tutti i campi multipli.
+            I json generati sono copie superficiali dell'originale (i campi non modificati sono condivisi).
+            Vengono generati al massimo max_fanout json per record (default da configurazione, None = nessun limite).
+            Se non ci sono campi multipli viene restituito il json originale.
+        '''
+        max_fanout = max_fanout if max_fanout is not None else self.config.split_max_fanout
+        multi = [(key, value.split(',')) for key, value in json_in.items()
+                 if isinstance(value, basestring) and value[:1].isalpha() and ',' in value]
+        if not multi:
+            yield json_in
+            return
+        if mode == "product":
+            keys = [key for key, values in multi]
+            splits = (zip(keys, combination) for combination in product(*[values for key, values in multi]))
+        elif mode == "single":
+            splits = (((key, value),) for key, values in multi for value in values)
+        else:
+            raise ValueError("splitMultipleValues - mode '{}' non valido (single/product)".format(mode))
+        for count, split in enumerate(splits):
+            if max_fanout is not None and count >= max_fanout:
+                self.logger.warning("splitMultipleValues - raggiunto il limite di {} json per record".format(max_fanout))
+                return
+            json_copy = dict(json_in)
+            json_copy.update(split)
+            yield json_copy
             
     
     ''' ##########################################################################
@@ -422,25 +1390,30 @@ class DataQuality(object):
             json, differenziando il caso grazie al booleano isList di default settato a False.      
             In particolare, utilizzando una funzione presente sul db postgresql, viene introdotto il campo
             - Identificativo del record
+            Gli identificativi vengono prenotati a blocchi (db.id_block_size) tramite RecordIdAllocator.
             Per maggiori informazioni, verificare la sezione 6.2.3 dell'Allegato D - Componenti di Sistema.
         '''
         try:
             self.logger.info("addRecordId - INIT")
             if isList:
                 self.logger.debug("Lista di json in input")
-                for json_obj in json_in:
-                    res = self.dbClient.executeQuery("SELECT * from {}.{}(%s);".format(self.config.db_schema, self.config.get_id_function), 
-                        (self.config.app_name,), isSelect=True)
-                    json_obj['Identificativo'] = res[0][0]
+                if hasattr(json_in, "__len__"):
+                    for json_obj, record_id in zip(json_in, self.idAllocator.take(len(json_in))):
+                        json_obj['Identificativo'] = record_id
+                else:
+                    for json_obj in json_in:
+                        json_obj['Identificativo'] = self.idAllocator.next()
                 self.logger.info("addRecordId - END")
                 return json_in
             else:
-                res = self.dbClient.executeQuery("SELECT * from {}.{}(%s);".format(self.config.db_schema, self.config.get_id_function), 
-                    (self.config.app_name,), isSelect=True)
-                json_in['Identificativo'] = res[0][0]
+                json_in['Identificativo'] = self.idAllocator.next()
                 return json_in
         except TypeError as te:
             self.logger.error("addRecordId - TypeError - {}".format(str(te)))
             raise
         except Exception as e:
-            self.logger.error("addRecordId - ERROR: {}".format(str(e)))
\ No newline at end of file
+            self.logger.error("addRecordId - ERROR: {}".format(str(e)))
+
+
+# "from dataQuality import *" esporta anche i nomi risolti al primo accesso (LAZY_NAMES)
+__all__ = [name for name in list(globals()) if not name.startswith("_")] + list(LAZY_NAMES)
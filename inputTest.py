@@ -2,4 +2,37 @@ date_UNT_FVM_PIC_02 = "01/02/2020 T 08:34:27 Z"
 date_UNT_FVM_PIC_03= ["2020/02/01 T 08:34:27 Z", "20/02/01 T 08:34:27 Z"]
 date_UNT_FVM_PIC_04= ["2020/01/02", "01-02-2020", "01/01/20", "01 01 2020", "01 01 20"]
 date_UNT_FVM_PIC_05= ["", "primo gennaio"]
-str_UNT_FVM_PIC_06= ["Autotreno", "camion", "AUTOTRENO", "autoTRENO"]
\ No newline at end of file
+str_UNT_FVM_PIC_06= ["Autotreno", "camion", "AUTOTRENO", "autoTRENO"]
+special_char_rows_UNT_FVM_PIC_07 = [("&", " e "), ("#", None), ("@", "a")]
+string_poss_rows_UNT_FVM_PIC_07 = [(["AUTOTRENO", "AUTOARTICOLATO"], "Autotreno"), (["CAMION", "AUTOCARRO"], "Camion")]
+str_UNT_FVM_PIC_08 = ["autotreno", "Autocarro", "bicicletta", "AUTOARTICOLATO"]
+str_poss_rows_UNT_FVM_PIC_08 = [(["AUTOTRENO"], "Autotreno"), (["AUTOCARRO", "AUTOTRENO"], "Camion"), (None, "Vuoto")]
+str_UNT_FVM_PIC_09 = ["Rossi & Figli #1", "info@camion", "nessun carattere", "a&&b".encode('utf-8')]
+special_char_rows_UNT_FVM_PIC_09 = [("&", " e "), ("#", None), ("@", "a"), ("&&", "-"), ("&", "ignorato")]
+schema_UNT_FVM_PIC_10 = {"type": "array", "items": {"type": "object", "required": ["Targa", "Tipo"],
+                         "properties": {"Targa": {"type": "string"}, "Tipo": {"type": "string"}, "Peso": {"type": "number"}}}}
+json_UNT_FVM_PIC_10 = [{"Targa": "AB123CD", "Tipo": "Camion", "Peso": 12.5}, {"Targa": "EF456GH", "Tipo": "Autotreno"}]
+json_UNT_FVM_PIC_11 = [{"Targa": "AB123CD", "Peso": "dodici"}]
+json_UNT_FVM_PIC_12 = json_UNT_FVM_PIC_10 + json_UNT_FVM_PIC_11 + [{"Tipo": 1, "Peso": "x"}]
+json_UNT_FVM_PIC_13 = [{"Targa": "", "Peso": 3}, {"Tipo": None, "Targa": "AB123CD"}]
+json_UNT_FVM_PIC_14 = [{"Targa": "AB123CD", "Assi": [2, 3]}, {"Assi": [2, 3], "Targa": "AB123CD"}, {"Targa": "AB123CD", "Assi": [3, 2]},
+                       {"Targa": "EF456GH", "Assi": [2]}, {"Targa": "AB123CD", "Assi": [2, 3]}]
+date_UNT_FVM_PIC_16 = ["2021-03-28T03:30:00Z", "2021-07-01 12:00:00.250", "2021-07-01", "12/31/2020 23:59:59", "13-01-2020",
+                       "2020/02/01 T 08:34:27 Z", "01/01/20", "2021-02-30", "primo gennaio", None]
+num_UNT_FVM_PIC_18 = [1, 2.5, 3.5, -0.4, "12.345", " 7 ", "1_000", "abc", "", None, True, float("nan"), "inf", 2 ** 60, 10 ** 20, b"2.5", "١٢٣"]
+int_UNT_FVM_PIC_18 = [1, 2, -3, 4.7, True]
+slot_UNT_FVM_PIC_18 = ["06-08", "06-25", "25-06", "xx-08", "0-0", "12"]
+bool_UNT_FVM_PIC_18 = ["true", "False", "si", 1, 0, None, "boh", ["x"]]
+boolean_values_UNT_FVM_PIC_18 = {"true_values": ["true", "True", "si", 1], "false_values": ["false", "False", "no", 0]}
+json_UNT_FVM_PIC_19 = {"Targa": "AB123CD", "Tipo": "Camion,Autotreno", "Colore": "rosso,blu,verde", "Note": "12,5", "Assi": [2, 3]}
+json_UNT_FVM_PIC_20 = [{"Città": "Forlì", "Età": 42, "Attivo": True, "Note": None, "Tipo": "Camion"},
+                       {"Città": "Perù", "Età": 7, "Attivo": False, "Note": "àèìòù", "Tipo": "Treno"}]
+records_UNT_FVM_PIC_29 = [{"n": 1, "s": "a]b,\"c\""}, 12345678, [1, 2, {"x": None}], "testo lungo [con] parentesi", {"n": 2.5, "b": True}]
+numbers_UNT_FVM_PIC_29 = [1.5, 22.25, {"a": 1e5}, -3, 1e-3, "x"]
+rules_UNT_FVM_PIC_30 = {"Data": "standardizeDate", "Attivo": ["standardizeBoolValue"],
+                        "Importo": [{"method": "standardizeNumericFormat", "args": {"comma": False}}],
+                        "Tipo": ["structuralStringErrorRepair", "toAscii"]}
+records_UNT_FVM_PIC_30 = [{"Data": "2020/02/01", "Attivo": "si", "Importo": "12,5", "Tipo": "autocarro&città"},
+                          {"Data": "2020/03/01", "Attivo": 0, "Importo": 7, "Tipo": "  camion "},
+                          {"Data": "primo gennaio", "Attivo": "boh", "Importo": "x"}]
+schema_number_UNT_FVM_PIC_17 = {"type": "array", "items": {"type": "object", "required": ["Tipo"], "properties": {"Tipo": {"type": "number"}}}}
@@ -0,0 +1,157 @@
+#!/usr/bin/env /opt/cloudera/parcels/CDH-7.1.7-1.cdh7.1.7.p0.15945976/lib/hue/build/env/bin/python
+
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from multiprocessing.util import Finalize
+from numbers import Number
+from dataQuality import DataQuality
+from utility import Logger
+
+# stato del processo worker (una istanza di DataQuality per processo)
+worker = None
+
+
+def initWorker(factory, steps):
+    ''' Inizializzatore dei processi worker: crea la DataQuality del processo (con la propria connessione al db e il
+        proprio file di log, suffisso con il pid), precarica le tabelle parametriche e registra la chiusura
+        (beforeEnd) all'uscita del processo. '''
+    global worker
+    ingestion = logging.getLogger("ingestion")
+    for handler in list(ingestion.handlers):
+        # handler ereditati dal padre con la fork: vengono staccati senza chiuderli (file e thread sono del padre)
+        ingestion.removeHandler(handler)
+    Logger.process_log_suffix = "worker{}".format(os.getpid())
+    dq = factory()
+    dq.preloadLookupTables()
+    worker = {"dq": dq, "steps": [bindStep(dq, step) for step in steps], "records": 0, "errors": 0, "seconds": 0.0}
+    Finalize(dq, dq.beforeEnd, exitpriority=10)
+
+
+def bindStep(dq, step):
+    ''' Uno step puo' essere il nome di un metodo di DataQuality, una tupla (nome, kwargs) oppure una funzione
+        f(dq, record). Il metodo riceve il record e ne ritorna la versione modificata (None = record invariato,
+        es. jsonValidation). '''
+    if callable(step):
+        return lambda record: step(dq, record)
+    name, kwargs = (step, {}) if isinstance(step, str) else step
+    method = getattr(dq, name)
+    return lambda record: method(record, **kwargs)
+
+
+def processChunk(offset, chunk):
+    ''' Applica gli step ad ogni record del blocco. Ritorna i record elaborati, gli errori (indice globale, messaggio)
+        e le statistiche cumulative del worker. '''
+    start = time.time()
+    results = []
+    errors = []
+    for i, record in enumerate(chunk):
+        try:
+            for step in worker["steps"]:
+                out = step(record)
+                record = record if out is None else out
+            results.append(record)
+        except Exception as exc:
+            errors.append((offset + i, str(exc)))
+    worker["records"] += len(chunk)
+    worker["errors"] += len(errors)
+    worker["seconds"] += time.time() - start
+    return results, errors, workerStats()
+
+
+def workerStats():
+    dq = worker["dq"]
+    stats = {"pid": os.getpid(), "records": worker["records"], "errors": worker["errors"], "seconds": worker["seconds"],
+             "lookup": dq.getLookupStats(), "record_id": dq.idAllocator.getStats()}
+    if dq.memoCaches:
+        stats["memoization"] = dq.getMemoStats()
+    return stats
+
+
+# contatori sommati tra i worker: gli altri valori (impostazioni come block_size/maxsize, dimensioni delle tabelle)
+# vengono riportati cosi' come sono e gli hit_rate ricalcolati dai contatori sommati
+COUNTERS = ("records", "errors", "seconds", "hits", "misses", "refreshes", "version_checks", "allocated", "queries",
+            "buffered", "size", "evictions", "invalidations")
+
+
+def mergeStats(stats_list):
+    ''' Unisce le statistiche (anche annidate) dei worker sommando solo i COUNTERS. '''
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                merged[key] = mergeStats([merged.get(key, {}), value])
+            elif key in COUNTERS and isinstance(value, Number):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = value
+    if "hit_rate" in merged:
+        total = merged.get("hits", 0) + merged.get("misses", 0)
+        merged["hit_rate"] = float(merged.get("hits", 0)) / total if total else 0.0
+    return merged
+
+
+class PipelineRunner(object):
+    ''' Esegue una sequenza di step di DataQuality su un dataset ripartendo i record, a blocchi di chunk_size, su un
+        pool di processi (workers, default numero di core). Ogni processo ha la propria DataQuality creata da factory.
+        Con ordered=True i record elaborati escono nello stesso ordine di ingresso. I record in errore vengono scartati
+        e riportati in errors; le statistiche dei worker vengono unite in getStats() al termine.
+    '''
+
+    def __init__(self, steps, workers=None, chunk_size=None, ordered=None, factory=DataQuality, config=None):
+        self.steps = list(steps)
+        self.workers = workers or getattr(config, "pipeline_workers", None) or os.cpu_count()
+        self.chunk_size = chunk_size or getattr(config, "pipeline_chunk_size", None) or 500
+        self.ordered = ordered if ordered is not None else getattr(config, "pipeline_ordered", True)
+        self.factory = factory
+        self.errors = []
+        self.workerStats = {}
+
+    def run(self, records):
+        ''' Generatore dei record elaborati. L'input (anche un generatore) viene letto a blocchi: restano in lavorazione
+            al massimo 2 blocchi per worker. '''
+        self.errors = []
+        self.workerStats = {}
+        records = iter(records)
+        max_pending = self.workers * 2
+        offset = 0
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker, initargs=(self.factory, self.steps)) as executor:
+            while True:
+                while len(pending) < max_pending:
+                    chunk = list(islice(records, self.chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(executor.submit(processChunk, offset, chunk))
+                    offset += len(chunk)
+                if not pending:
+                    break
+                if self.ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    results, errors, stats = future.result()
+                    self.errors.extend(errors)
+                    # le statistiche sono cumulative per worker: senza ordine (wait) vale quella piu' recente
+                    pid = stats.pop("pid")
+                    if pid not in self.workerStats or stats["records"] >= self.workerStats[pid]["records"]:
+                        self.workerStats[pid] = stats
+                    for record in results:
+                        yield record
+        self.errors.sort()
+
+    def runAll(self, records):
+        ''' Come run, ma ritorna la lista completa dei record elaborati. '''
+        return list(self.run(records))
+
+    def getStats(self):
+        ''' Statistiche dei worker (record, errori, tempi, cache) sommate su tutti i processi. '''
+        stats = mergeStats(self.workerStats.values())
+        stats["workers"] = len(self.workerStats)
+        return stats
@@ -1,6 +1,13 @@
 import unittest
+import tempfile
 from dataQuality import *
 from inputTest import *
+from utility import LookupTableCache, Logger, RecordIdAllocator, CompressedRotatingFileHandler, Db, PooledDb
+from pipelineRunner import PipelineRunner, mergeStats
+import gzip
+import jsonschema.exceptions
+import threading
+import gc
 
 #ordinamento
 unittest.TestLoader.sortTestMethodsUsing = lambda *args: -1
@@ -46,4 +53,817 @@ class TestDataQuality(unittest.TestCase):
     def test_capitalize_first_letter_UNT_FVM_PIC_06(self):
         for strT in str_UNT_FVM_PIC_06:
             ret = self.dq.capitalizeFirstLetter(strT)
-            self.assertTrue(ret[0].isupper())
\ No newline at end of file
+            self.assertTrue(ret[0].isupper())
+
+#finto client db: conta le query eseguite sulle tabelle parametriche
+class FakeDbClient(object):
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = []
+
+    def executeQuery(self, query, parameter=None, commit=False, isSelect=False):
+        self.queries.append(query)
+        return list(self.tables[query.split(".")[-1]])
+
+    def executeMany(self, query, tuples, commit=False):
+        self.queries.append(query)
+
+    def executeProcedure(self, procname, commit=False, parameters=None):
+        self.queries.append(procname)
+
+
+class TestLookupTableCache(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDbClient({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": string_poss_rows_UNT_FVM_PIC_07})
+
+    def test_lookup_cache_single_load_UNT_FVM_PIC_07(self):
+        cache = LookupTableCache(self.db, "dq")
+        for i in range(10):
+            self.assertEqual(cache.get("special_char"), special_char_rows_UNT_FVM_PIC_07)
+            self.assertEqual(cache.get("string_poss"), string_poss_rows_UNT_FVM_PIC_07)
+        self.assertEqual(len(self.db.queries), 2)
+        stats = cache.getStats()
+        self.assertEqual((stats["misses"], stats["hits"], stats["refreshes"]), (2, 18, 0))
+
+    def test_lookup_cache_refresh_UNT_FVM_PIC_07(self):
+        cache = LookupTableCache(self.db, "dq", ttl=0)
+        cache.get("special_char")
+        cache.get("special_char")
+        self.assertEqual(cache.getStats()["refreshes"], 1)
+        self.assertEqual(cache.generation("special_char"), 1)
+        self.assertEqual(len(self.db.queries), 2)
+
+    def test_lookup_cache_invalidate_UNT_FVM_PIC_07(self):
+        cache = LookupTableCache(self.db, "dq")
+        notified = []
+        cache.addRefreshListener(notified.append)
+        cache.get("special_char")
+        cache.invalidate("special_char")
+        self.assertEqual(notified, ["special_char"])
+        cache.get("special_char")
+        cache.get("special_char")
+        self.assertEqual(len(self.db.queries), 2)
+        self.assertEqual(cache.generation("special_char"), 1)
+
+
+#configurazione minima per i test che non leggono config.json
+class FakeConfig(object):
+    app_name = "test"
+    schema_path = tempfile.mkdtemp()
+    schema_file = "schema.json"
+    validation_max_errors = 10
+    dedup_max_memory_fingerprints = None
+    split_max_fanout = None
+    write_batch_size = 2
+    rules = {}
+    db_schema = "dq"
+    defaultValue_string = "--"
+    defaultValue_date = "01-01-0001"
+    defaultValue_number = -1
+    cfg = {"booleanValues": boolean_values_UNT_FVM_PIC_18}
+    getJsonValue = ScriptConfiguration.getJsonValue
+    special_char_table = "special_char"
+    string_poss_table = "string_poss"
+
+
+def buildTestDataQuality(tables):
+    dq = DataQuality()
+    dq.config = FakeConfig()
+    dq.logger = Logger(class_name='', app_name='test', local_log_file=tempfile.mkstemp(suffix=".log")[1])
+    dq.dbClient = FakeDbClient(tables)
+    dq.lookupCache = LookupTableCache(dq.dbClient, dq.config.db_schema)
+    dq.validatorCache = dict()
+    dq.memoCaches = dict()
+    dq.normalizedKeys = dict()
+    dq.rulePlans = dict()
+    return dq
+
+
+class TestDataQualityLookup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": str_poss_rows_UNT_FVM_PIC_08})
+
+    def test_standardize_text_first_match_UNT_FVM_PIC_08(self):
+        ret = [self.dq.standardizeText(strT) for strT in str_UNT_FVM_PIC_08]
+        self.assertEqual(ret, ["Autotreno", "Camion", None, None])
+
+    def test_standardize_text_many_UNT_FVM_PIC_08(self):
+        ret = self.dq.standardizeTextMany(str_UNT_FVM_PIC_08 + [None])
+        self.assertEqual(ret, [self.dq.standardizeText(strT) for strT in str_UNT_FVM_PIC_08] + [None])
+
+    def test_special_char_UNT_FVM_PIC_09(self):
+        ret = [self.dq.specialChar(strT) for strT in str_UNT_FVM_PIC_09]
+        self.assertEqual(ret, ["Rossi  e  Figli 1", "infoacamion", "nessun carattere", "a e  e b"])
+        self.assertEqual(self.dq.specialCharMany(str_UNT_FVM_PIC_09), ret)
+
+    def test_special_char_replacer_UNT_FVM_PIC_09(self):
+        replacer = SpecialCharReplacer(special_char_rows_UNT_FVM_PIC_09)
+        self.assertIsNotNone(replacer.pattern)
+        self.assertEqual(replacer.replaceMany(str_UNT_FVM_PIC_09), ["Rossi  e  Figli 1", "infoacamion", "nessun carattere", "a-b"])
+
+
+class TestDataQualityValidation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+        cls.schema = os.path.join(FakeConfig.schema_path, FakeConfig.schema_file)
+        with open(cls.schema, "w") as schema_file:
+            json.dump(schema_UNT_FVM_PIC_10, schema_file)
+
+    def test_json_validation_cached_UNT_FVM_PIC_10(self):
+        self.dq.jsonValidation(json_UNT_FVM_PIC_10)
+        validator = self.dq.getValidator()
+        self.dq.validateMany(json_UNT_FVM_PIC_10)
+        self.assertIs(self.dq.getValidator(self.schema), validator)
+        self.assertEqual(self.dq.json_schema, schema_UNT_FVM_PIC_10)
+
+    def test_validate_many_invalid_UNT_FVM_PIC_11(self):
+        with self.assertRaises(ValidationError):
+            self.dq.validateMany(json_UNT_FVM_PIC_10 + json_UNT_FVM_PIC_11)
+        with self.assertRaisesRegex(ValidationError, "record 0"):
+            self.dq.validateMany([json_UNT_FVM_PIC_10])
+        with self.assertRaises(ValidationError):
+            self.dq.jsonValidation(json_UNT_FVM_PIC_11)
+
+    def test_validate_batch_quarantine_UNT_FVM_PIC_12(self):
+        valid = []
+        quarantine = os.path.join(FakeConfig.schema_path, "quarantine.json")
+        stats = self.dq.validateBatch(iter(json_UNT_FVM_PIC_12), valid.append, quarantine, max_errors=2)
+        self.assertEqual(valid, json_UNT_FVM_PIC_10)
+        self.assertEqual((stats["total"], stats["valid"], stats["invalid"]), (4, 2, 2))
+        with open(quarantine) as quarantine_file:
+            rejected = [json.loads(line) for line in quarantine_file]
+        self.assertEqual([r["record"] for r in rejected], json_UNT_FVM_PIC_12[2:])
+        self.assertEqual(len(rejected[1]["errors"]), 2)
+        self.assertTrue(rejected[1]["truncated"])
+        self.assertEqual(stats["errors_by_field"]["Tipo"], 2)
+        self.assertEqual(stats["errors_by_type"]["required"], 2)
+        self.dq.validateBatch(iter(json_UNT_FVM_PIC_12), [].append, quarantine, max_errors=0)
+        with open(quarantine) as quarantine_file:
+            self.assertEqual([len(json.loads(line)["errors"]) for line in quarantine_file], [0, 0])
+
+    def test_validate_batch_valid_file_UNT_FVM_PIC_12(self):
+        valid_path = os.path.join(FakeConfig.schema_path, "valid.json")
+        quarantine = os.path.join(FakeConfig.schema_path, "quarantine.json")
+        record = dict(json_UNT_FVM_PIC_10[0], Arrivo=datetime(2020, 1, 1, 8, 30))
+        stats = self.dq.validateBatch([record], valid_path, quarantine)
+        self.assertEqual(stats["valid"], 1)
+        with open(valid_path) as valid_file:
+            self.assertEqual([json.loads(line)["Arrivo"] for line in valid_file], ["2020-01-01 08:30:00"])
+
+    def test_default_values_UNT_FVM_PIC_13(self):
+        self.dq.getValidator()
+        self.assertEqual(self.dq.default_map, {"Targa": "--", "Tipo": "--"})
+        self.assertEqual(self.dq.defaultValues("Targa"), "--")
+        self.assertIsNone(self.dq.defaultValues("Peso"))
+        self.assertEqual(self.dq.structuralStringErrorRepair("Tipo", ""), "--")
+        ret = self.dq.fillMandatoryFields(deepcopy(json_UNT_FVM_PIC_13), isList=True)
+        self.assertEqual(ret, [{"Targa": "--", "Tipo": "--", "Peso": 3}, {"Tipo": "--", "Targa": "AB123CD"}])
+
+
+class TestDataQualityDedup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+
+    def test_remove_duplicate_json_UNT_FVM_PIC_14(self):
+        ret = self.dq.removeDuplicateJson(json_UNT_FVM_PIC_14)
+        self.assertEqual(ret, [json_UNT_FVM_PIC_14[0], json_UNT_FVM_PIC_14[2], json_UNT_FVM_PIC_14[3]])
+
+    def test_iter_unique_json_spill_UNT_FVM_PIC_14(self):
+        ret = list(self.dq.iterUniqueJson(iter(json_UNT_FVM_PIC_14 * 3), unordered_lists=True, max_memory=1))
+        self.assertEqual(ret, [json_UNT_FVM_PIC_14[0], json_UNT_FVM_PIC_14[3]])
+        self.assertEqual(list(self.dq.iterUniqueJson(iter(json_UNT_FVM_PIC_14 * 2), unordered_lists=True, max_memory=0)), ret)
+
+
+#finto client db: simula una sequence per la funzione di assegnazione degli identificativi
+class FakeIdDbClient(object):
+    def __init__(self):
+        self.last_id = 0
+        self.queries = []
+
+    def executeQuery(self, query, parameter=None, commit=False, isSelect=False):
+        self.queries.append((query, parameter))
+        n = parameter[1] if len(parameter) > 1 else 1
+        self.last_id += n
+        return [(i,) for i in range(self.last_id - n + 1, self.last_id + 1)]
+
+
+class TestRecordIdAllocator(unittest.TestCase):
+    def test_add_record_id_block_UNT_FVM_PIC_15(self):
+        dq = buildTestDataQuality({})
+        dq.dbClient = FakeIdDbClient()
+        dq.idAllocator = RecordIdAllocator(dq.dbClient, "dq", "next_id", "test", block_size=4)
+        records = dq.addRecordId([{"n": i} for i in range(6)], isList=True)
+        single = dq.addRecordId({"n": 6})
+        self.assertEqual([r["Identificativo"] for r in records] + [single["Identificativo"]], list(range(1, 8)))
+        self.assertEqual(len(dq.dbClient.queries), 2)
+        self.assertIn("generate_series", dq.dbClient.queries[0][0])
+        self.assertEqual(dq.idAllocator.getStats()["buffered"], 3)
+
+
+class TestDateParser(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+        cls.dq.dateParser = DateParser()
+
+    def reference(self, value):
+        #implementazione originaria basata solo su dateutil
+        try:
+            date = parser.parse(value)
+        except:
+            return None
+        naive = datetime.strptime(date.strftime("%Y-%m-%dT%H:%M:%SZ"), "%Y-%m-%dT%H:%M:%SZ")
+        return pytz.timezone("Europe/Vienna").localize(naive, is_dst=None).astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def test_standardize_date_fast_path_UNT_FVM_PIC_16(self):
+        for date in date_UNT_FVM_PIC_16:
+            self.assertEqual(self.dq.standardizeDate(date), self.reference(date))
+        self.assertGreater(self.dq.dateParser.getStats()["hits"], 0)
+
+    def test_standardize_date_many_UNT_FVM_PIC_16(self):
+        ret = self.dq.standardizeDateMany(date_UNT_FVM_PIC_16)
+        self.assertEqual(ret, [self.reference(date) for date in date_UNT_FVM_PIC_16])
+        self.assertEqual(self.dq.dateParser.infer(date_UNT_FVM_PIC_04 + ["12-25-2020", "07-04-2021"]), "%m-%d-%Y")
+
+    def test_date_parser_per_instance_UNT_FVM_PIC_16(self):
+        dq = buildTestDataQuality({})
+        self.assertIsNot(dq.dateParser, buildTestDataQuality({}).dateParser)
+        values = date_UNT_FVM_PIC_03 + date_UNT_FVM_PIC_04
+        self.assertEqual(dq.standardizeDateMany(iter(values)), dq.standardizeDateMany(values))
+        self.assertTrue(self.dq.is_date("2021-07-01"))
+        self.assertEqual(self.dq.extractYearFromEveryDate("12/31/2020 23:59:59"), 2020)
+
+
+class TestMemoization(unittest.TestCase):
+    def test_memoization_UNT_FVM_PIC_17(self):
+        dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": str_poss_rows_UNT_FVM_PIC_08})
+        dq.lookupCache.ttl = 0
+        dq.enableMemoization({"is_number": 2, "structuralStringErrorRepair": 10})
+        self.assertEqual([dq.is_number(v) for v in [1, True, 1, "x", "y", 1]], [True, False, True, False, False, True])
+        stats = dq.getMemoStats()["is_number"]
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 5, 2))
+        self.assertEqual(dq.structuralStringErrorRepair("Tipo", "autocarro"), "Camion")
+        self.assertEqual(dq.structuralStringErrorRepair("Tipo", "autocarro"), "Camion")
+        self.assertGreaterEqual(dq.getMemoStats()["structuralStringErrorRepair"]["invalidations"], 1)
+
+    def test_memoization_schema_switch_UNT_FVM_PIC_17(self):
+        dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": str_poss_rows_UNT_FVM_PIC_08})
+        dq.enableMemoization({"structuralStringErrorRepair": 10})
+        schemas = []
+        for i, schema in enumerate([schema_UNT_FVM_PIC_10, schema_number_UNT_FVM_PIC_17]):
+            schemas.append(os.path.join(tempfile.mkdtemp(), "schema{}.json".format(i)))
+            with open(schemas[-1], "w") as schema_file:
+                json.dump(schema, schema_file)
+        dq.getValidator(schemas[0])
+        dq.getValidator(schemas[1])
+        dq.getValidator(schemas[0])
+        self.assertEqual(dq.structuralStringErrorRepair("Tipo", ""), "--")
+        dq.getValidator(schemas[1])
+        self.assertEqual(dq.structuralStringErrorRepair("Tipo", ""), -1)
+
+
+class TestColumnMode(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+
+    def test_numeric_column_UNT_FVM_PIC_18(self):
+        self.assertEqual(self.dq.standardizeNumericFormatColumn(num_UNT_FVM_PIC_18),
+            [self.dq.standardizeNumericFormat(v) for v in num_UNT_FVM_PIC_18])
+        self.assertEqual(self.dq.standardizeNumericFormatColumn(num_UNT_FVM_PIC_18, comma=False),
+            [self.dq.standardizeNumericFormat(v, comma=False) for v in num_UNT_FVM_PIC_18])
+        self.assertEqual(self.dq.isNumberColumn(num_UNT_FVM_PIC_18),
+            [v is not None and self.dq.is_number(v) for v in num_UNT_FVM_PIC_18])
+        self.assertEqual(self.dq.byAThousandColumn(int_UNT_FVM_PIC_18), [self.dq.byAThousand(v) for v in int_UNT_FVM_PIC_18])
+
+    def test_time_slot_and_bool_column_UNT_FVM_PIC_18(self):
+        self.assertEqual(self.dq.verifyTimeSlotColumn(slot_UNT_FVM_PIC_18, "-"),
+            [self.dq.verifyTimeSlot(v, "-") for v in slot_UNT_FVM_PIC_18])
+        self.assertEqual(self.dq.standardizeBoolValueColumn(bool_UNT_FVM_PIC_18),
+            [self.dq.standardizeBoolValue(v) for v in bool_UNT_FVM_PIC_18])
+
+
+class TestSplitMultipleValues(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+
+    def test_split_multiple_values_single_UNT_FVM_PIC_19(self):
+        ret = self.dq.splitMultipleValues(json_UNT_FVM_PIC_19)
+        self.assertEqual([(r["Tipo"], r["Colore"]) for r in ret], [("Camion", "rosso,blu,verde"), ("Autotreno", "rosso,blu,verde"),
+            ("Camion,Autotreno", "rosso"), ("Camion,Autotreno", "blu"), ("Camion,Autotreno", "verde")])
+        self.assertTrue(all(r["Note"] == "12,5" and r["Assi"] is json_UNT_FVM_PIC_19["Assi"] for r in ret))
+        self.assertEqual(json_UNT_FVM_PIC_19["Tipo"], "Camion,Autotreno")
+
+    def test_split_multiple_values_product_UNT_FVM_PIC_19(self):
+        ret = self.dq.splitMultipleValues(json_UNT_FVM_PIC_19, mode="product")
+        self.assertEqual(len(ret), 6)
+        self.assertEqual((ret[-1]["Tipo"], ret[-1]["Colore"]), ("Autotreno", "verde"))
+        self.assertEqual(len(self.dq.splitMultipleValues(json_UNT_FVM_PIC_19, mode="product", max_fanout=4)), 4)
+        self.assertEqual(self.dq.splitMultipleValues(json_UNT_FVM_PIC_19, max_fanout=0), [])
+        self.assertEqual(self.dq.splitMultipleValues({"Targa": "AB123CD"}), [{"Targa": "AB123CD"}])
+
+
+class TestDecodingUnicode(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dq = buildTestDataQuality({})
+
+    def test_decoding_unicode_json_UNT_FVM_PIC_20(self):
+        ret = self.dq.decodingUnicodeJson(json_UNT_FVM_PIC_20[0])
+        self.assertEqual(ret, {"Citta": "Forli", "Eta": 42, "Attivo": True, "Note": None, "Tipo": "Camion"})
+        self.assertEqual(self.dq.normalizedKeys["Città"], "Citta")
+        ret = self.dq.decodingUnicodeJsonMany(json_UNT_FVM_PIC_20)
+        self.assertEqual(ret, [self.dq.decodingUnicodeJson(j) for j in json_UNT_FVM_PIC_20])
+        self.assertEqual(ret[1]["Note"], "aeiou")
+
+    def test_decoding_unicode_non_string_key_UNT_FVM_PIC_20(self):
+        with self.assertRaises(TypeError):
+            self.dq.normalizeKey(1)
+        self.assertEqual(self.dq.decodingUnicodeJson({1: "a", "Città": "c"}), {"Citta": "c"})
+        self.assertEqual(self.dq.decodingUnicodeJsonMany([{1: "a", "Città": "c"}]), [{"Citta": "c"}])
+
+
+class TestLogger(unittest.TestCase):
+    def test_lazy_logging_UNT_FVM_PIC_21(self):
+        logger = buildTestDataQuality({}).logger
+        calls = []
+        logger.debug(lambda: calls.append("debug") or "mai costruito")
+        logger.info("valore %s di %s", 1, 2)
+        logger.info(lambda: calls.append("info") or "costruito")
+        self.assertEqual(calls, ["info"])
+        self.assertFalse(logger.isEnabledFor(Logger.LogLevel.DEBUG))
+        self.assertTrue(logger.formatMessage("valore %s di %s", (1, 2), False) == "valore 1 di 2")
+        self.assertTrue(logger.formatMessage("100%", (), True).endswith(" - 100%"))
+
+    def test_queue_logging_UNT_FVM_PIC_22(self):
+        log_file = tempfile.mkstemp(suffix=".log")[1]
+        logger = Logger(class_name='', app_name='test', local_log_file=log_file, queue_size=50, batch_size=10)
+        for i in range(200):
+            logger.info("record %s", i)
+        logger.flush()
+        with open(log_file) as f:
+            lines = f.readlines()
+        self.assertEqual(sum(1 for line in lines if "- record " in line), 200)
+        self.assertTrue(lines[-1].rstrip().endswith("record 199"))
+        logger.closeLogger(None)
+
+    def test_queue_logging_release_UNT_FVM_PIC_22(self):
+        log_file = tempfile.mkstemp(suffix=".log")[1]
+        queued = Logger(class_name='', app_name='test', local_log_file=log_file, queue_size=5)
+        handler = queued.queue_handler
+        del queued
+        gc.collect()
+        self.assertNotIn(handler, logging.getLogger("ingestion").handlers)
+        logger = Logger(class_name='', app_name='test', local_log_file=log_file)
+        for i in range(20):
+            logger.info("record %s", i)
+        logger.closeLogger(None)
+        # listener fermato (o processo figlio dopo fork): scrittura diretta invece di attendere sulla coda piena
+        handler.emit(logging.makeLogRecord({"msg": "scritto senza coda", "levelno": logging.INFO}))
+        handler.listener.handler.flush()
+        with open(log_file) as f:
+            self.assertIn("scritto senza coda", f.read())
+
+    def test_compressed_rotation_UNT_FVM_PIC_22(self):
+        log_file = tempfile.mkstemp(suffix=".log")[1]
+        handler = CompressedRotatingFileHandler(log_file, maxBytes=100, backupCount=2, compress=True)
+        for i in range(20):
+            handler.emit(logging.makeLogRecord({"msg": "riga di log numero {}".format(i)}))
+        handler.close()
+        with gzip.open(log_file + ".1.gz", "rt") as f:
+            self.assertIn("riga di log", f.read())
+        self.assertFalse(os.path.exists(log_file + ".1"))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics_UNT_FVM_PIC_23(self):
+        dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": str_poss_rows_UNT_FVM_PIC_08})
+        dq.enableMetrics()
+        for strT in str_UNT_FVM_PIC_08:
+            dq.structuralStringErrorRepair("Tipo", strT)
+        dq.standardizeNumericFormatColumn(num_UNT_FVM_PIC_18)
+        stats = dq.metrics.getStats()
+        self.assertEqual(stats["methods"]["structuralStringErrorRepair"]["count"], 4)
+        self.assertEqual(stats["methods"]["specialChar"]["count"], 4)
+        self.assertEqual(stats["methods"]["standardizeNumericFormatColumn"]["records"], len(num_UNT_FVM_PIC_18))
+        self.assertEqual(sorted(stats["queries"]), ["SELECT dq.special_char", "SELECT dq.string_poss"])
+        json_path, prometheus_path = tempfile.mkstemp()[1], tempfile.mkstemp()[1]
+        dq.dumpMetrics(json_path, prometheus_path)
+        with open(prometheus_path) as f:
+            self.assertIn('dataquality_method_seconds_count{method="specialChar"} 4', f.read())
+        with open(json_path) as f:
+            self.assertEqual(json.load(f)["methods"]["standardizeText"]["count"], 4)
+
+    def test_metrics_streaming_records_UNT_FVM_PIC_23(self):
+        dq = buildTestDataQuality({})
+        dq.enableMetrics()
+        out = list(dq.iterUniqueJson(iter([{"a": 1}, {"a": 1}, {"a": 2}])))
+        self.assertEqual(len(out), 2)
+        stats = dq.metrics.getStats()["methods"]
+        self.assertEqual((stats["iterUniqueJson"]["count"], stats["iterUniqueJson"]["records"]), (1, 2))
+        schema = tempfile.mkstemp(suffix=".json")[1]
+        with open(schema, "w") as schema_file:
+            json.dump(schema_UNT_FVM_PIC_10, schema_file)
+        dq.validateBatch(iter(json_UNT_FVM_PIC_12), [].append, tempfile.mkstemp()[1], schema=schema)
+        self.assertEqual(dq.metrics.getStats()["methods"]["validateBatch"]["records"], len(json_UNT_FVM_PIC_12))
+        metrics = dq.metrics
+        self.assertEqual(metrics.queryKey("UPDATE dq.t SET a='x' where id=5"), "UPDATE dq.t")
+        self.assertEqual(metrics.queryKey("insert into dq.t (a) values ('x')"), "INSERT dq.t")
+        self.assertEqual(metrics.queryKey("truncate table dq.t"), "TRUNCATE dq.t")
+        self.assertEqual(metrics.queryKey("SELECT 1"), "SELECT")
+
+
+class FakeCopyCursor:
+    def __init__(self):
+        self.copied = []
+        self.statements = []
+
+    def execute(self, query, parameter=None):
+        self.statements.append(query)
+
+    def copy_expert(self, query, buf):
+        self.copied.append((query, buf.read()))
+
+    def close(self):
+        pass
+
+
+class FakeCopyConnection:
+    autocommit = False
+    closed = False
+
+    def __init__(self):
+        self.cursorObj = FakeCopyCursor()
+
+    def cursor(self):
+        return self.cursorObj
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class TestCopyLoader(unittest.TestCase):
+    def test_copy_records_UNT_FVM_PIC_24(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeCopyConnection()
+        records = [{"id": 1, "name": "a\tb", "dt": datetime(2020, 1, 2, 8, 34, 27)}, {"id": 2, "name": None, "tags": ["x"]}]
+        loaded = db.copyRecordsIntoTable("t", iter(records), ["id", "name", "tags", "dt"], chunk_size=1)
+        self.assertEqual(loaded, 2)
+        copied = db.connection.cursorObj.copied
+        self.assertEqual(len(copied), 2)
+        self.assertEqual(copied[0], ("COPY t (id, name, tags, dt) FROM STDIN", "1\ta\\tb\t\\N\t2020-01-02 08:34:27\n"))
+        self.assertEqual(copied[1][1], '2\t\\N\t["x"]\t\\N\n')
+
+
+class FakeNamedCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.closed = False
+        self.fetched = []
+
+    def execute(self, query, parameter=None):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        self.fetched.append(len(rows))
+        return rows
+
+    def __iter__(self):
+        while self.rows:
+            yield self.rows.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStreamConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.cursors = []
+
+    def cursor(self, name=None):
+        self.cursors.append(FakeNamedCursor(self.rows))
+        return self.cursors[-1]
+
+
+class TestStreamQuery(unittest.TestCase):
+    def test_stream_query_UNT_FVM_PIC_25(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeStreamConnection([(i,) for i in range(5)])
+        self.assertEqual([len(b) for b in db.streamQuery("select 1", itersize=2, batches=True)], [2, 2, 1])
+        stream = db.streamQuery("select 1")
+        self.assertEqual(next(stream), (0,))
+        stream.close()
+        self.assertTrue(db.connection.cursors[-1].closed)
+        self.assertTrue(db.connection.cursors[0].closed)
+
+
+class FakePreparedCursor(FakeCopyCursor):
+    def execute(self, query, parameter=None):
+        self.statements.append((query, parameter))
+
+    def fetchall(self):
+        return []
+
+
+class TestPreparedStatements(unittest.TestCase):
+    def test_prepared_cache_UNT_FVM_PIC_26(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeCopyConnection()
+        db.connection.cursorObj = FakePreparedCursor()
+        db.prepared_cache_size = 1
+        db.prepared = {}
+        db.prepared_lock = threading.Lock()
+        db.prepared_stats = {"prepared": 0, "executed": 0, "reused": 0, "deallocated": 0}
+        query = "SELECT * from s.get_id(%s) where x like 'a%%';"
+        db.executeQuery(query, ("app",), isSelect=True)
+        db.executeQuery(query, ("app",), isSelect=True)
+        db.executeQuery("SELECT 1", isSelect=True)
+        db.executeQuery("truncate table t")
+        statements = db.connection.cursorObj.statements
+        name = statements[0][0].split()[1]
+        self.assertEqual(statements[0], ("PREPARE {} AS SELECT * from s.get_id($1) where x like 'a%'".format(name), None))
+        self.assertEqual(statements[1], ("EXECUTE {} (%s)".format(name), ("app",)))
+        self.assertEqual(statements[3][0].split()[0], "DEALLOCATE")
+        self.assertEqual(statements[-1], ("truncate table t", None))
+        db.executeQuery("SELECT * from t where x in %s", (("a", "b"),), isSelect=True)
+        self.assertEqual(statements[-1], ("SELECT * from t where x in %s", (("a", "b"),)))
+        self.assertEqual(db.getPreparedStats(), {"prepared": 2, "executed": 3, "reused": 1, "deallocated": 1, "cached": 1})
+
+
+class TestBulkUpdate(unittest.TestCase):
+    def test_bulk_update_UNT_FVM_PIC_27(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeCopyConnection()
+        db.connection.cursorObj = FakePreparedCursor()
+        db.connection.cursorObj.rowcount = 2
+        rows = ({"id": i, "name": "n{}".format(i), "flag": True} for i in range(3))
+        self.assertEqual(db.bulkUpdateTable("s.t", rows, ["id"], batch_size=2), 4)
+        cursor = db.connection.cursorObj
+        statements = [query for query, parameter in cursor.statements]
+        temp_table = statements[0].split()[3]
+        self.assertEqual(statements[0], "CREATE TEMP TABLE {} AS SELECT id, flag, name FROM s.t WITH NO DATA".format(temp_table))
+        self.assertEqual(statements.count("UPDATE s.t t SET flag = s.flag, name = s.name FROM {} s WHERE t.id = s.id".format(temp_table)), 2)
+        self.assertEqual(statements[-1], "DROP TABLE {}".format(temp_table))
+        self.assertEqual([data for query, data in cursor.copied], ["0\tt\tn0\n1\tt\tn1\n", "2\tt\tn2\n"])
+
+    def test_update_table_where_UNT_FVM_PIC_27(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeCopyConnection()
+        db.connection.cursorObj = FakePreparedCursor()
+        db.updateTableWhere("t", {"name": "o'neil"}, "code like 'A%'")
+        self.assertEqual(db.connection.cursorObj.statements, [("UPDATE t SET name=%s where code like 'A%%'", ["o'neil"])])
+        db.connection.cursorObj.statements = []
+        with self.assertRaises(ValueError):
+            db.updateTableWhere("t", {}, "code like 'A%'")
+        db.updateTableWhere("t", {"name": "x"}, "code like %s", where_parameter=["A%"])
+        self.assertEqual(db.connection.cursorObj.statements, [("UPDATE t SET name=%s where code like %s", ["x", "A%"])])
+
+    def test_bulk_update_duplicate_keys_UNT_FVM_PIC_27(self):
+        db = Db.__new__(Db)
+        db.connected = True
+        db.connection = FakeCopyConnection()
+        db.connection.cursorObj = FakePreparedCursor()
+        db.connection.cursorObj.rowcount = 1
+        db.bulkUpdateTable("s.t", [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}, {"id": 1, "name": "c"}], ["id"])
+        self.assertEqual([data for query, data in db.connection.cursorObj.copied], ["1\tc\n2\tb\n"])
+
+
+def buildPipelineDataQuality():
+    dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": string_poss_rows_UNT_FVM_PIC_07})
+    dq.idAllocator = RecordIdAllocator(FakeIdDbClient(), "dq", "next_id", "test", block_size=10)
+    return dq
+
+
+def capitalizeName(dq, record):
+    record["name"] = dq.capitalizeFirstLetter(record["name"])
+
+
+def workerLogging(dq, record):
+    record["log"] = (dq.logger.getLoggerFileName(), len(logging.getLogger("ingestion").handlers))
+
+
+class TestPipelineRunner(unittest.TestCase):
+    def test_pipeline_runner_UNT_FVM_PIC_28(self):
+        records = [{"n": i, "name": "camion"} for i in range(25)]
+        records[7] = {"n": 7}
+        runner = PipelineRunner([capitalizeName, "addRecordId"], workers=2, chunk_size=4, ordered=True, factory=buildPipelineDataQuality)
+        out = runner.runAll(records)
+        self.assertEqual([r["n"] for r in out], [i for i in range(25) if i != 7])
+        self.assertTrue(all(r["name"] == "Camion" and "Identificativo" in r for r in out))
+        self.assertEqual([index for index, message in runner.errors], [7])
+        stats = runner.getStats()
+        self.assertEqual((stats["records"], stats["errors"]), (25, 1))
+        self.assertEqual(stats["lookup"]["misses"], 2 * stats["workers"])
+        unordered = PipelineRunner([capitalizeName], workers=2, chunk_size=3, ordered=False, factory=buildPipelineDataQuality)
+        self.assertEqual(sorted(r["n"] for r in unordered.run(records[:7])), list(range(7)))
+        self.assertEqual(unordered.getStats()["records"], 7)
+
+    def test_pipeline_worker_logging_UNT_FVM_PIC_28(self):
+        runner = PipelineRunner([workerLogging], workers=2, chunk_size=1, factory=buildPipelineDataQuality)
+        for log_file, handlers in set(r["log"] for r in runner.run({"n": i} for i in range(6))):
+            self.assertRegex(log_file, r"_worker\d+\.log$")
+            self.assertEqual(handlers, 1)
+
+    def test_merge_stats_UNT_FVM_PIC_28(self):
+        merged = mergeStats([{"records": 10, "lookup": {"hits": 9, "misses": 1, "hit_rate": 0.9, "tables": {"t": 5}},
+                              "record_id": {"allocated": 10, "block_size": 100}},
+                             {"records": 5, "lookup": {"hits": 3, "misses": 3, "hit_rate": 0.5, "tables": {"t": 5}},
+                              "record_id": {"allocated": 5, "block_size": 100}}])
+        self.assertEqual(merged["records"], 15)
+        self.assertEqual(merged["lookup"], {"hits": 12, "misses": 4, "hit_rate": 0.75, "tables": {"t": 5}})
+        self.assertEqual(merged["record_id"], {"allocated": 15, "block_size": 100})
+
+
+class TestJsonRecordIO(unittest.TestCase):
+    def test_json_array_reader_UNT_FVM_PIC_29(self):
+        path = tempfile.mkstemp(suffix=".json.gz")[1]
+        with gzip.open(path, "wt") as f:
+            f.write("\n  " + json.dumps(records_UNT_FVM_PIC_29, indent=1) + "\n")
+        reader = JsonRecordReader(path, buffer_size=7)
+        self.assertEqual(list(reader), records_UNT_FVM_PIC_29)
+        self.assertEqual(reader.records, len(records_UNT_FVM_PIC_29))
+
+    def test_json_array_reader_split_numbers_UNT_FVM_PIC_29(self):
+        path = tempfile.mkstemp(suffix=".json")[1]
+        with open(path, "w") as f:
+            f.write(json.dumps(numbers_UNT_FVM_PIC_29))
+        for buffer_size in range(1, 21):
+            self.assertEqual(list(JsonRecordReader(path, buffer_size=buffer_size)), numbers_UNT_FVM_PIC_29)
+        with open(path, "w") as f:
+            f.write("[1, 2")
+        with self.assertRaises(ValueError):
+            list(JsonRecordReader(path, buffer_size=2))
+
+    def test_ndjson_writer_reader_UNT_FVM_PIC_29(self):
+        dq = buildTestDataQuality({})
+        dq.file_path = os.path.join(tempfile.mkdtemp(), "out.ndjson")
+        with dq.openRecordWriter() as writer:
+            writer.writeMany(records_UNT_FVM_PIC_29)
+            self.assertFalse(os.path.exists(dq.file_path))
+        self.assertEqual(writer.records, len(records_UNT_FVM_PIC_29))
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(dq.file_path).st_mode & 0o777, 0o666 & ~umask)
+        self.assertEqual(list(dq.readRecords(dq.file_path)), records_UNT_FVM_PIC_29)
+        with self.assertRaises(KeyError):
+            with dq.openRecordWriter() as writer:
+                writer.write({"n": 1})
+                raise KeyError("abort")
+        self.assertEqual(list(dq.readRecords(dq.file_path)), records_UNT_FVM_PIC_29)
+        self.assertEqual(os.listdir(os.path.dirname(dq.file_path)), ["out.ndjson"])
+
+        array_path = dq.file_path + ".json"
+        with dq.openRecordWriter(array_path, as_array=True) as writer:
+            writer.writeMany(records_UNT_FVM_PIC_29)
+        with open(array_path) as f:
+            self.assertEqual(json.load(f), records_UNT_FVM_PIC_29)
+
+
+class TestFieldRules(unittest.TestCase):
+    def test_apply_rules_UNT_FVM_PIC_30(self):
+        dq = buildTestDataQuality({"special_char": special_char_rows_UNT_FVM_PIC_07, "string_poss": string_poss_rows_UNT_FVM_PIC_07})
+        dq.config.rules = {"schema.json": rules_UNT_FVM_PIC_30}
+        expected = [dict(record) for record in records_UNT_FVM_PIC_30]
+        for record in expected:
+            record["Data"] = dq.standardizeDate(record["Data"])
+            record["Attivo"] = dq.standardizeBoolValue(record["Attivo"])
+            record["Importo"] = dq.standardizeNumericFormat(record["Importo"], comma=False)
+            if "Tipo" in record:
+                record["Tipo"] = dq.toAscii(dq.structuralStringErrorRepair("Tipo", record["Tipo"]))
+        out = list(dq.iterApplyRules([dict(record) for record in records_UNT_FVM_PIC_30]))
+        self.assertEqual(out, expected)
+        self.assertNotIn("Tipo", out[2])
+        self.assertEqual(len(dq.rulePlans["schema.json"]), 4)
+        self.assertEqual(dq.applyRules([{"Tipo": None}]), [{"Tipo": None}])
+        dq.config.rules = {"schema.json": {"Tipo": ["standardizeText"]}}
+        dq.rulePlans = dict()
+        self.assertEqual([r["Tipo"] for r in dq.applyRules([{"Tipo": "autocarro"}, {"Tipo": "bicicletta"}, {"Tipo": 3}])],
+                         ["Camion", "bicicletta", 3])
+        dq.config.rules = {"schema.json": {"Tipo": ["toAscii"]}}
+        dq.rulePlans = dict()
+        self.assertEqual([r["Tipo"] for r in dq.applyRules([{"Tipo": "città"}, {"Tipo": 3}, {"Tipo": None}])], ["citta", 3, None])
+        dq.config.rules = {"schema.json": {"Tipo": ["nonEsiste"]}}
+        dq.rulePlans = dict()
+        with self.assertRaises(ValueError):
+            dq.compileRules()
+
+
+class TestLazyStartup(unittest.TestCase):
+    def buildLazyConfig(self, opened, memoization_enabled=False):
+        config = FakeConfig()
+        config.file_path_dest = ""
+        config.log_local_folder = tempfile.mkdtemp()
+        config.log_filename = "dq.log"
+        config.level_debug = config.level_verbose = False
+        config.log_queue_size, config.log_queue_full_policy, config.log_queue_batch_size, config.log_compress_rotated = 0, "block", 500, False
+        config.memoization_enabled, config.memoization_sizes, config.metrics_enabled = memoization_enabled, None, False
+        config.lookup_cache_ttl = config.lookup_cache_version_column = None
+        config.db_host, config.db_port, config.db_database = "localhost", 5432, "dq"
+        config.getDbClient = lambda: opened.append(1) or FakeDbClient({"special_char": special_char_rows_UNT_FVM_PIC_07})
+        return config
+
+    def test_lazy_db_connection_UNT_FVM_PIC_31(self):
+        import dataQuality
+        opened = []
+        dq = dataQuality.DataQuality(self.buildLazyConfig(opened))
+        self.assertEqual(dq.capitalizeFirstLetter("camion"), "Camion")
+        dq.beforeEnd()
+        self.assertEqual(opened, [])
+        self.assertEqual(dq.specialChar("a&b"), "a e b")
+        self.assertEqual(dq.specialChar("a@b"), "aab")
+        self.assertEqual(opened, [1])
+        self.assertIs(dq.LOCAL_TZ, dataQuality.DataQuality.timezones["Europe/Vienna"])
+        self.assertNotIn("ValidationError", vars(dataQuality))
+        self.assertIs(dataQuality.ValidationError, jsonschema.exceptions.ValidationError)
+
+    def test_lazy_db_connection_memoization_UNT_FVM_PIC_31(self):
+        import dataQuality
+        opened = []
+        dq = dataQuality.DataQuality(self.buildLazyConfig(opened, memoization_enabled=True))
+        self.assertEqual(dq.capitalizeFirstLetter("camion"), "Camion")
+        self.assertEqual(opened, [])
+        self.assertEqual(dq.specialChar("a&b"), "a e b")
+        self.assertEqual(opened, [1])
+        # il listener di invalidazione della memoizzazione e' registrato alla creazione (lazy) della cache
+        dq.memoCaches["structuralStringErrorRepair"].put("chiave", "valore")
+        dq.lookupCache.invalidate("special_char")
+        self.assertEqual(dq.memoCaches["structuralStringErrorRepair"].getStats()["size"], 0)
+
+    def test_metrics_instrument_db_once_UNT_FVM_PIC_31(self):
+        db = FakeDbClient({"t": [(1,)]})
+        Metrics().instrumentDb(db)
+        metrics = Metrics()
+        metrics.instrumentDb(db)
+        db.executeQuery("SELECT * from dq.t", isSelect=True)
+        self.assertEqual(len(db.queries), 1)
+
+
+class StubPool(object):
+    def __init__(self):
+        self.closed = False
+        self.out = 0
+        self.returned = []
+
+    def getconn(self):
+        self.out += 1
+        return FakeCopyConnection()
+
+    def putconn(self, conn, close=False):
+        self.out -= 1
+        self.returned.append(conn)
+
+    def closeall(self):
+        self.closed = True
+
+
+class StubPooledDb(PooledDb):
+    def createPool(self):
+        return StubPool()
+
+
+class TestPooledDb(unittest.TestCase):
+    def test_pooled_checkout_UNT_FVM_PIC_32(self):
+        db = StubPooledDb("h", "d", "u", "p", "s", 5432, maxconn=1, timeout=0.05)
+        with db.checkout() as conn:
+            self.assertIs(db.connection, conn)
+            self.assertEqual(db.pool.out, 1)
+        self.assertEqual(db.pool.out, 0)
+        with self.assertRaises(KeyError):
+            with db.checkout():
+                raise KeyError("errore")
+        self.assertEqual(db.pool.out, 0)
+
+    def test_pooled_thread_exit_and_exhaustion_UNT_FVM_PIC_32(self):
+        db = StubPooledDb("h", "d", "u", "p", "s", 5432, maxconn=1, timeout=0.05)
+        worker = threading.Thread(target=lambda: db.connection)
+        worker.start()
+        worker.join()
+        self.assertEqual(db.pool.out, 0)
+        db.connection
+        errors = []
+
+        def borrow():
+            try:
+                db.connection
+            except Db.DatabaseError as exc:
+                errors.append(exc)
+        other = threading.Thread(target=borrow)
+        other.start()
+        other.join()
+        self.assertEqual(len(errors), 1)
+        db.releaseConnection()
+        self.assertEqual(db.pool.out, 0)
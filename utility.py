@@ -3,25 +3,42 @@
 import sys
 import os
 import inspect
+import importlib
 from enum import Enum
 import logging
 import traceback
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
-from logging.handlers import RotatingFileHandler
+import psycopg2.extras
+import io
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler, QueueHandler
 import json
+import time
+import threading
+import queue
+import gzip
+import shutil
+import random
+import re
+import weakref
+import itertools
+from collections import deque, OrderedDict
+from collections.abc import Iterator
+from types import GeneratorType
+from itertools import islice, chain
 from datetime import datetime
 
 class ScriptConfiguration:
+    # file json gia' letti nel processo: {path: (mtime, contenuto)}
+    json_cache = {}
+
     def __init__(self):
         CONFIG_FILE = 'config.json'
         CONFIG_COMMON_FILE = "common.json"
         try:
-            with open(CONFIG_FILE, 'r') as config_json:
-                custom_cfg = json.loads(config_json.read())
-                
-            with open(CONFIG_COMMON_FILE, 'r') as c_json:
-                common_cfg = json.loads(c_json.read())
+            custom_cfg = self.loadJsonFile(CONFIG_FILE)
+            common_cfg = self.loadJsonFile(CONFIG_COMMON_FILE)
         except Exception as e:
             print("initVar - ERROR")
             #raise self.manageException(e, info="ERROR JSON decode: unable to decode json file... check {}".format(CONFIG_FILE))
@@ -36,6 +53,9 @@ class ScriptConfiguration:
         self.schema_file = self.getJsonValue(config, "", "app", "schema_file")
         self.schema_path = self.getJsonValue(config, "", "app", "schema_path")
         self.file_path_dest = self.getJsonValue(config, "", "app", "file_path_dest")
+        self.write_batch_size = self.getJsonValue(config, 1000, "app", "write_batch_size")
+        self.validation_max_errors = self.getJsonValue(config, 10, "app", "validation_max_errors")
+        self.split_max_fanout = self.getJsonValue(config, None, "app", "split_max_fanout")
         
         # LOG PARAMS
         self.level_debug = self.getJsonValue(config, False, "log", "level_debug")
@@ -43,6 +63,10 @@ class ScriptConfiguration:
         self.log_filename = self.getStringTodayFormat(self.getJsonValue(config, None, "log", "filename"))
         self.log_local_folder = self.getStringTodayFormat(self.getJsonValue(config, None, "log", "local_folder"))
         self.log_remote_folder = self.getStringTodayFormat(self.getJsonValue(config, None, "log", "remote_folder"))
+        self.log_queue_size = self.getJsonValue(config, 0, "log", "queue_size")
+        self.log_queue_full_policy = self.getJsonValue(config, "block", "log", "queue_full_policy")
+        self.log_queue_batch_size = self.getJsonValue(config, 500, "log", "queue_batch_size")
+        self.log_compress_rotated = self.getJsonValue(config, False, "log", "compress_rotated")
         
         
         # DB PARAMS
@@ -55,11 +79,42 @@ class ScriptConfiguration:
         self.db_schema = self.getJsonValue(config, None, "db", "schema")
         self.db_user = self.getJsonValue(config, None, "db", "user")
         self.db_password = self.getJsonValue(config, None, "db", "password")
+        # pool di connessioni (PooledDb) se valorizzato db.pool.max
+        self.db_pool_min = self.getJsonValue(config, 1, "db", "pool", "min")
+        self.db_pool_max = self.getJsonValue(config, None, "db", "pool", "max")
+        self.db_pool_timeout = self.getJsonValue(config, 30, "db", "pool", "timeout_seconds")
+        self.db_prepared_cache_size = self.getJsonValue(config, 0, "db", "prepared_statements", "cache_size")
         
         self.special_char_table = self.getJsonValue(config, None, "db", "special_char_table")
         self.string_poss_table = self.getJsonValue(config, None, "db", "string_poss_table")
         self.get_id_function = self.getJsonValue(config, None, "db", "get_id_function")
-        
+        self.get_id_range_function = self.getJsonValue(config, None, "db", "get_id_range_function")
+        self.id_block_size = self.getJsonValue(config, 1, "db", "id_block_size")
+
+        # LOOKUP CACHE PARAMS (ttl in secondi, None = nessuna scadenza)
+        self.lookup_cache_ttl = self.getJsonValue(config, None, "db", "lookup_cache", "ttl_seconds")
+        self.lookup_cache_version_column = self.getJsonValue(config, None, "db", "lookup_cache", "version_column")
+
+        # DEDUP PARAMS (None = fingerprint sempre in memoria)
+        self.dedup_max_memory_fingerprints = self.getJsonValue(config, None, "dedup", "max_memory_fingerprints")
+
+        # MEMOIZATION PARAMS ({metodo: dimensione massima})
+        self.memoization_enabled = self.getJsonValue(config, False, "memoization", "enabled")
+        self.memoization_sizes = self.getJsonValue(config, None, "memoization", "sizes")
+
+        # METRICS PARAMS
+        self.metrics_enabled = self.getJsonValue(config, False, "metrics", "enabled")
+        self.metrics_json_path = self.getJsonValue(config, None, "metrics", "json_path")
+        self.metrics_prometheus_path = self.getJsonValue(config, None, "metrics", "prometheus_path")
+
+        # PIPELINE PARAMS (workers None = numero di core)
+        self.pipeline_workers = self.getJsonValue(config, None, "pipeline", "workers")
+        self.pipeline_chunk_size = self.getJsonValue(config, 500, "pipeline", "chunk_size")
+        self.pipeline_ordered = self.getJsonValue(config, True, "pipeline", "ordered")
+
+        # FIELD RULES ({schema: {campo: [regola, ...]}}, vedi DataQuality.compileRules)
+        self.rules = self.getJsonValue(config, {}, "rules")
+
         # DEFAULT VALUES
         self.defaultValue_string = self.getJsonValue(config, None, "defaultValues", "string")
         self.defaultValue_date = self.getJsonValue(config, None, "defaultValues", "date")
@@ -81,6 +136,18 @@ class ScriptConfiguration:
         return dict1
     
     
+    @classmethod
+    def loadJsonFile(cls, path):
+        ''' Legge un file json, riusando il contenuto gia' letto se il file non e' cambiato (stesso mtime).
+            Ritorna sempre una copia, cosi' che le modifiche del chiamante non alterino la cache. '''
+        mtime = os.path.getmtime(path)
+        cached = cls.json_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'r') as json_file:
+                cached = (mtime, json_file.read())
+            cls.json_cache[path] = cached
+        return json.loads(cached[1])
+
     def getJsonValue(self, data, defval=None, *args):
         try:
             val = data
@@ -120,7 +187,12 @@ class ScriptConfiguration:
                 assert schema is not None, "DB client params - 'schema' not set in configuration file"
                 assert port is not None, "DB client params - 'port' not set in configuration file"
                 
-                self.dbClient = Db(host, database, user, password, schema, port)
+                if self.db_pool_max:
+                    self.dbClient = PooledDb(host, database, user, password, schema, port, minconn=self.db_pool_min, maxconn=self.db_pool_max,
+                                             timeout=self.db_pool_timeout,
+                                             prepared_cache_size=self.db_prepared_cache_size)
+                else:
+                    self.dbClient = Db(host, database, user, password, schema, port, prepared_cache_size=self.db_prepared_cache_size)
             except Exception as e:
                 print("getDbClient - ERROR")
                 raise Exception(str(e))
@@ -128,6 +200,132 @@ class ScriptConfiguration:
         return self.dbClient
 
 
+class LazyImport(object):
+    ''' Modulo importato al primo accesso ad un suo attributo, per non pagare all'avvio l'import di librerie pesanti
+        non sempre utilizzate. Con optional=True un modulo non installato non solleva errori: available() ritorna False. '''
+
+    def __init__(self, name, optional=False):
+        self.name = name
+        self.optional = optional
+        self.module = None
+        self.missing = False
+
+    def load(self):
+        if self.module is None and not self.missing:
+            try:
+                self.module = importlib.import_module(self.name)
+            except ImportError:
+                if not self.optional:
+                    raise
+                self.missing = True
+        return self.module
+
+    def available(self):
+        return self.load() is not None
+
+    def __getattr__(self, attr):
+        if attr in ("name", "optional", "module", "missing"):
+            raise AttributeError(attr)
+        module = self.load()
+        if module is None:
+            raise ImportError("modulo '{}' non installato".format(self.name))
+        return getattr(module, attr)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    ''' RotatingFileHandler che comprime in gzip i file ruotati (se compress e' True) e che, durante la scrittura
+        di un batch di record (defer_flush True), rimanda il flush dello stream a fine batch. '''
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, compress=False):
+        super(CompressedRotatingFileHandler, self).__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.defer_flush = False
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = self.gzipRotator
+
+    def gzipRotator(self, source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def flush(self):
+        if not self.defer_flush:
+            super(CompressedRotatingFileHandler, self).flush()
+
+
+class BoundedQueueHandler(QueueHandler):
+    ''' QueueHandler su coda limitata: con full_policy "block" il thread chiamante attende che si liberi spazio,
+        con "drop" il record viene scartato e conteggiato in dropped. Se il thread di scrittura non e' attivo
+        (listener fermato o processo figlio dopo una fork) il record viene scritto direttamente sul handler
+        del listener, senza passare dalla coda. '''
+
+    def __init__(self, log_queue, full_policy="block"):
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.block = full_policy != "drop"
+        self.dropped = 0
+        self.listener = None
+        self.pid = os.getpid()
+
+    def enqueue(self, record):
+        if self.listener is not None and (self.pid != os.getpid() or not self.listener.thread.is_alive()):
+            self.listener.handler.handle(record)
+        elif self.block:
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+
+class BatchingQueueListener:
+    ''' Thread in background che svuota la coda dei log e scrive i record sul handler a batch di batch_size,
+        con un solo flush per batch. La rotazione (ed eventuale compressione) avviene in questo thread. '''
+    STOP = None
+
+    def __init__(self, log_queue, handler, batch_size=500):
+        self.queue = log_queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self.run, name="LogWriter")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.handler.defer_flush = True
+            try:
+                for record in batch:
+                    if record is self.STOP:
+                        running = False
+                    elif record.levelno >= self.handler.level:
+                        self.handler.handle(record)
+            finally:
+                self.handler.defer_flush = False
+                self.handler.flush()
+                for record in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        ''' Attende che tutti i record in coda siano stati scritti. '''
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join()
+
+
 class Logger:
     local_log_filename = None
     mylogger = None
@@ -135,6 +333,11 @@ class Logger:
     enable_print = False
     enable_verbose = False
     level_num = -1
+    threshold = 2
+    last_second = None
+    last_timestamp = None
+    # suffisso aggiunto al nome del file di log (prima dell'estensione), es. "worker1234" nei processi di PipelineRunner
+    process_log_suffix = None
 
     class LogLevel(str, Enum):
         VERBOSE = 0
@@ -144,8 +347,14 @@ class Logger:
         ERROR = 4
         CRITICAL = 5
 
+    # valori interi dei livelli, per il controllo veloce prima di costruire il messaggio
+    LEVEL_VERBOSE, LEVEL_DEBUG, LEVEL_INFO, LEVEL_WARNING, LEVEL_ERROR = 0, 1, 2, 3, 4
 
-    def __init__(self, class_name, app_name, local_log_file, time_precision="second", log_level="INFO"):
+    def __init__(self, class_name, app_name, local_log_file, time_precision="second", log_level="INFO",
+                 queue_size=0, full_policy="block", batch_size=500, compress_rotated=False):
+        ''' Con queue_size > 0 i record vengono accodati su una coda limitata e scritti a batch da un thread in
+            background (full_policy "block" o "drop" a coda piena); con compress_rotated i file ruotati vengono
+            compressi in gzip. '''
         mode = {
             "day": '%Y%m%d',
             "hour": '%Y%m%d%H',
@@ -168,10 +377,15 @@ class Logger:
             level_ = logging.INFO
             self.level_num = self.LogLevel.INFO
 
+        self.threshold = int(self.level_num)
+
         if time_precision not in mode.keys():
             time_precision = "second"
 
         # logging.basicConfig(filename=LOCAL_LOG_FILE, level=logging.INFO)
+        if Logger.process_log_suffix:
+            root, ext = os.path.splitext(local_log_file)
+            local_log_file = "{}_{}{}".format(root, Logger.process_log_suffix, ext)
         self.local_log_filename = local_log_file
         self.hdfs_date_format = datetime.today().strftime( mode[time_precision] )
 
@@ -183,10 +397,20 @@ class Logger:
 
         formatter = logging.Formatter( '%(name)s\t- %(levelname)s\t- (%(threadName)-10s)\t- %(message)s' )
 
-        self.logger_handler = logging.handlers.RotatingFileHandler( self.local_log_filename, maxBytes = 18874368, backupCount = 1)
+        self.logger_handler = CompressedRotatingFileHandler( self.local_log_filename, maxBytes = 18874368, backupCount = 1, compress = compress_rotated)
         self.logger_handler.setLevel( level_)
         self.logger_handler.setFormatter( formatter )
-        Logger.mylogger.addHandler( self.logger_handler )
+        self.queue_handler = None
+        self.queue_listener = None
+        if queue_size and queue_size > 0:
+            self.queue_handler = BoundedQueueHandler( queue.Queue( queue_size ), full_policy )
+            self.queue_handler.setLevel( level_ )
+            self.queue_listener = BatchingQueueListener( self.queue_handler.queue, self.logger_handler, batch_size )
+            self.queue_handler.listener = self.queue_listener
+            self.queue_listener.start()
+            Logger.mylogger.addHandler( self.queue_handler )
+        else:
+            Logger.mylogger.addHandler( self.logger_handler )
 
         self.mylogger_handler = self.logger_handler
 
@@ -198,11 +422,29 @@ class Logger:
             consoleHandler.setFormatter(formatter)
             Logger.mylogger.addHandler(consoleHandler)
 
+    def flush(self):
+        ''' Attende la scrittura dei record eventualmente in coda e forza il flush del file di log. '''
+        if self.queue_listener is not None:
+            self.queue_listener.flush()
+        self.logger_handler.flush()
+
+    def getDroppedCount(self):
+        ''' Numero di record scartati a coda piena (full_policy "drop"). '''
+        return self.queue_handler.dropped if self.queue_handler is not None else 0
+
+    def stopQueue(self):
+        ''' Stacca il handler della coda dal logger condiviso e ferma il thread di scrittura. '''
+        if getattr(self, "queue_listener", None) is not None:
+            Logger.mylogger.removeHandler( self.queue_handler )
+            self.queue_listener.stop()
+
     def closeLogger(self, logger_handler):
+        self.stopQueue()
         self.logger_handler.flush()
         self.logger_handler.close()
 
     def __del__(self):
+        self.stopQueue()
         self.mylogger_handler.flush()
         self.mylogger_handler.close()
 
@@ -216,9 +458,32 @@ class Logger:
         proc = subprocess.Popen( "rm -f {}".format( self.getLoggerFileName() ), shell=True )
         proc.communicate()
 
-    def error(self, msg, flag_date=True, exc_info=None):
-        if self.level_num <= self.LogLevel.ERROR :
-            m = msg if not flag_date else "{} - {}".format( datetime.now().strftime( "%Y/%m/%d %H:%M:%S" ), msg )
+    def isEnabledFor(self, level):
+        ''' Ritorna True se i messaggi del livello in input (LogLevel) vengono scritti. '''
+        return self.threshold <= int(level)
+
+    def formatMessage(self, msg, args, flag_date):
+        ''' Costruisce il messaggio solo dopo il controllo del livello: msg puo' essere una stringa con argomenti
+            in stile '%s' oppure una callable senza argomenti che ritorna il messaggio. '''
+        if callable(msg):
+            msg = msg()
+        if args:
+            msg = msg % args
+        if not flag_date:
+            return msg
+        now = int(time.time())
+        if now != self.last_second:
+            self.last_timestamp = datetime.fromtimestamp(now).strftime( "%Y/%m/%d %H:%M:%S" )
+            self.last_second = now
+        return "{} - {}".format( self.last_timestamp, msg )
+
+    def callerName(self):
+        caller = sys._getframe(2).f_code.co_name
+        return sys._getframe(3).f_code.co_name if caller == "wrapper" else caller
+
+    def error(self, msg, *args, flag_date=True, exc_info=None):
+        if self.threshold <= Logger.LEVEL_ERROR :
+            m = self.formatMessage( msg, args, flag_date )
     
             if self.enable_print:
                 print( "ERROR - {}".format( m ) )
@@ -226,42 +491,38 @@ class Logger:
             if exc_info is None:
                 Logger.mylogger.error( m )
             else:
-                Logger.mylogger.error( m, exc_info )
+                Logger.mylogger.error( m, exc_info=exc_info )
 
-    def warning(self, msg, flag_date=True):
-        if self.level_num <= self.LogLevel.WARNING :
-            m = msg if not flag_date else "{} - {}".format( datetime.now().strftime( "%Y/%m/%d %H:%M:%S" ), msg )
+    def warning(self, msg, *args, flag_date=True):
+        if self.threshold <= Logger.LEVEL_WARNING :
+            m = self.formatMessage( msg, args, flag_date )
     
             if self.enable_print:
                 print( "WARNING - {}".format( m ) )
             Logger.mylogger.warning( m )
 
-    def info(self, msg, flag_date=True):
-        if self.level_num <= self.LogLevel.INFO :
-            m = msg if not flag_date else "{} - {}".format( datetime.now().strftime( "%Y/%m/%d %H:%M:%S" ), msg )
+    def info(self, msg, *args, flag_date=True):
+        if self.threshold <= Logger.LEVEL_INFO :
+            m = self.formatMessage( msg, args, flag_date )
     
             if self.enable_print:
                 print( "INFO - {}".format( m ) )
             Logger.mylogger.info( m )
 
-    def debug(self, msg, flag_date=True):
-        if self.level_num <= self.LogLevel.DEBUG :
-            caller = inspect.stack()[1][3]
-            method = inspect.stack()[2][3] if caller == "wrapper" else caller
-            m = msg if not flag_date else "{} - {}".format( datetime.now().strftime( "%Y/%m/%d %H:%M:%S" ), msg )
+    def debug(self, msg, *args, flag_date=True):
+        if self.threshold <= Logger.LEVEL_DEBUG :
+            m = self.formatMessage( msg, args, flag_date )
     
             if self.enable_print:
-                print( "DEBUG - {} - {}".format(method, m))
+                print( "DEBUG - {} - {}".format(self.callerName(), m))
             Logger.mylogger.debug( m )
 
-    def verbose(self, msg, flag_date=True):
-        if self.level_num <= self.LogLevel.VERBOSE :
-            caller = inspect.stack()[1][3]
-            method = inspect.stack()[2][3] if caller == "wrapper" else caller
-            m = msg if not flag_date else "{} - {}".format( datetime.now().strftime( "%Y/%m/%d %H:%M:%S" ), msg )
+    def verbose(self, msg, *args, flag_date=True):
+        if self.threshold <= Logger.LEVEL_VERBOSE :
+            m = self.formatMessage( msg, args, flag_date )
     
             if self.enable_print:
-                print( "VERBOSE - {} - {}".format(method, m))
+                print( "VERBOSE - {} - {}".format(self.callerName(), m))
             Logger.mylogger.debug( " (v) {}".format(m) )
 
     def debug_old(self, msg, flag_date=True):
@@ -298,7 +559,16 @@ class Db:
     DICT_VALUE = "VALUE"
     DICT_TYPE = "TYPE_VALUE"
 
-    def __init__(self, db_host, db_database, user, password, schema=None, port=None):
+    PREPARABLE = ("SELECT", "INSERT", "UPDATE", "DELETE")
+    PLACEHOLDER = re.compile(r"%%|%s")
+    statement_ids = itertools.count(1)
+    temp_ids = itertools.count(1)
+
+    def __init__(self, db_host, db_database, user, password, schema=None, port=None, prepared_cache_size=0):
+        self.prepared_cache_size = prepared_cache_size
+        self.prepared = weakref.WeakKeyDictionary()
+        self.prepared_lock = threading.Lock()
+        self.prepared_stats = {"prepared": 0, "executed": 0, "reused": 0, "deallocated": 0}
         self.db_host = db_host
         self.db_database = db_database
         self.user = user
@@ -309,14 +579,17 @@ class Db:
         self.db_port = port
         self.openConnection()
 
+    def connectionParams(self):
+        return dict(host=self.db_host, \
+            database=self.db_database, \
+            user=self.user, \
+            password=self.password, \
+            options="-c standard_conforming_strings=on".format(self.db_schema))
+
     def openConnection(self):
         try:
                 
-            self.connection = psycopg2.connect(host=self.db_host, \
-                database=self.db_database, \
-                user=self.user, \
-                password=self.password, \
-                options="-c standard_conforming_strings=on".format(self.db_schema))
+            self.connection = psycopg2.connect(**self.connectionParams())
             
             self.connected = True
         except Exception as e:
@@ -353,9 +626,6 @@ class Db:
 
     def executeMany(self, query, tuples, commit=False):
 
-        print("executeMany - query == {}".format(query))
-        print("executeMany - tuples == {}".format(tuples))
-
         if self.connected:
             cursor = self.connection.cursor()
             try:                            
@@ -373,7 +643,8 @@ class Db:
         if self.connected:
             cursor = self.connection.cursor()
             try:                
-                cursor.execute(query, parameter) if parameter else cursor.execute(query)
+                if not (getattr(self, "prepared_cache_size", 0) and self.executePrepared(cursor, query, parameter)):
+                    cursor.execute(query, parameter) if parameter else cursor.execute(query)
                 if commit:
                     self.connection.commit()
                 if isSelect:
@@ -386,6 +657,87 @@ class Db:
         else:
             pass
 
+    def preparedStatement(self, query, parameter):
+        ''' Ritorna il testo da passare a PREPARE (segnaposto %s convertiti in $1..$n) oppure None se la query non e'
+            preparabile: non e' una singola SELECT/INSERT/UPDATE/DELETE, ha parametri con nome oppure parametri
+            tupla/lista (es. "x IN %s"), che psycopg2 espande in piu' valori. '''
+        statement = query.strip().rstrip(";")
+        if ";" in statement or statement[:6].upper() not in self.PREPARABLE or isinstance(parameter, dict):
+            return None
+        if not parameter:
+            return statement
+        if any(isinstance(value, (tuple, list)) for value in parameter):
+            return None
+        counter = itertools.count(1)
+        return self.PLACEHOLDER.sub(lambda m: "%" if m.group(0) == "%%" else "${}".format(next(counter)), statement)
+
+    def executePrepared(self, cursor, query, parameter=None):
+        ''' Esegue la query tramite PREPARE/EXECUTE usando la cache degli statement preparati della connessione
+            corrente (chiave = testo sql). La cache e' limitata a prepared_cache_size statement: oltre, quello usato
+            meno di recente viene rimosso con DEALLOCATE. Ritorna False se la query non e' preparabile. '''
+        statement = self.preparedStatement(query, parameter)
+        if statement is None:
+            return False
+        with self.prepared_lock:
+            cache, lock = self.prepared.setdefault(self.connection, (OrderedDict(), threading.Lock()))
+        # il lock della connessione copre lookup, eviction, PREPARE ed EXECUTE: un altro thread sulla stessa
+        # connessione non puo' rimuovere lo statement tra la ricerca in cache e la sua esecuzione
+        with lock:
+            name = cache.get(query)
+            if name is not None:
+                cache.move_to_end(query)
+                self.countPrepared("reused")
+            else:
+                while len(cache) >= self.prepared_cache_size:
+                    _, evicted = cache.popitem(last=False)
+                    cursor.execute("DEALLOCATE {}".format(evicted))
+                    self.countPrepared("deallocated")
+                name = "dq_stmt_{}".format(next(self.statement_ids))
+                cursor.execute("PREPARE {} AS {}".format(name, statement))
+                cache[query] = name
+                self.countPrepared("prepared")
+            if parameter:
+                cursor.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(parameter))), parameter)
+            else:
+                cursor.execute("EXECUTE {}".format(name))
+            self.countPrepared("executed")
+        return True
+
+    def countPrepared(self, counter):
+        with self.prepared_lock:
+            self.prepared_stats[counter] += 1
+
+    def getPreparedStats(self):
+        with self.prepared_lock:
+            return dict(self.prepared_stats, cached=sum(len(cache) for cache, lock in self.prepared.values()))
+
+    STREAM_ITERSIZE = 2000
+
+    def streamQuery(self, query, parameter=None, itersize=None, batches=False):
+        ''' Esegue una SELECT con un cursore lato server (named cursor) e restituisce un generatore che legge le righe
+            a blocchi di itersize dal server: una riga alla volta, oppure una lista di righe per blocco se batches=True.
+            Il cursore viene chiuso anche se il consumatore interrompe l'iterazione prima della fine.
+        '''
+        if not self.connected:
+            return
+        itersize = itersize or self.STREAM_ITERSIZE
+        self.stream_counter = getattr(self, "stream_counter", 0) + 1
+        cursor = self.connection.cursor(name="dq_stream_{}_{}".format(os.getpid(), self.stream_counter))
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, parameter) if parameter else cursor.execute(query)
+            if batches:
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield rows
+            else:
+                for row in cursor:
+                    yield row
+        finally:
+            cursor.close()
+
     def truncateTable(self, table_name):
         query = "truncate table {}".format(table_name)
         self.executeQuery(query)
@@ -405,55 +757,173 @@ class Db:
         self.executeQuery(query)
 
     # value_dict = dictionary contenente i valori da modificare e le chiavi sono i nomi delle colonne
-    def updateTableWhere(self, table_name, value_dict, where_clause="", commit=False):
+    def updateTableWhere(self, table_name, value_dict, where_clause="", commit=False, where_parameter=None):
+        ''' Aggiorna le righe che soddisfano where_clause con i valori di value_dict (passati come parametri della query).
+            Eventuali parametri della where_clause (segnaposto %s) vanno passati in where_parameter.
+            Solleva ValueError se value_dict e' vuoto (nessuna colonna da aggiornare). '''
+        if not value_dict:
+            raise ValueError("updateTableWhere - nessuna colonna da aggiornare per la tabella '{}'".format(table_name))
+        parameter = list(value_dict.values()) + list(where_parameter or [])
         query = "UPDATE {} SET ".format(table_name)
-        query += ", ".join("{}='{}'".format(k, v) for k, v in value_dict.items())
+        query += ", ".join("{}=%s".format(k) for k in value_dict.keys())
         if where_clause:
-            query += " where {}".format(where_clause)
+            # i valori sono sempre bindati: un '%' letterale della where_clause va raddoppiato (se non gia' parametrica)
+            query += " where {}".format(where_clause if where_parameter else where_clause.replace("%", "%%"))
 
-        self.executeQuery(query, commit)
+        self.executeQuery(query, parameter, commit=commit)
+
+    def bulkUpdateTable(self, table_name, rows, key_columns, columns=None, batch_size=10000, commit=False, use_copy=True):
+        ''' Aggiornamento massivo: rows e' un iterabile di dict con le colonne chiave (key_columns) e le colonne da
+            modificare (columns, di default le altre chiavi del primo record; tutte le righe devono avere le stesse colonne).
+            Le righe vengono caricate a blocchi di batch_size in una tabella temporanea con la stessa struttura della
+            tabella (COPY o, in alternativa, INSERT multi-riga) e applicate con un solo UPDATE ... FROM per blocco.
+            A parita' di chiave all'interno dello stesso blocco vale l'ultima riga. Ritorna il numero di righe aggiornate.
+        '''
+        if not self.connected:
+            return 0
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        key_columns = list(key_columns)
+        columns = list(columns) if columns else sorted(set(first.keys()) - set(key_columns))
+        all_columns = key_columns + columns
+        temp_table = "dq_bulk_update_{}".format(next(self.temp_ids))
+        copy_sql = "COPY {} ({}) FROM STDIN".format(temp_table, ", ".join(all_columns))
+        update_sql = "UPDATE {} t SET {} FROM {} s WHERE {}".format(table_name,
+                                                                    ", ".join("{0} = s.{0}".format(col) for col in columns),
+                                                                    temp_table,
+                                                                    " AND ".join("t.{0} = s.{0}".format(col) for col in key_columns))
+        rows = chain([first], rows)
+        updated = 0
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA".format(temp_table, ", ".join(all_columns), table_name))
+            while True:
+                chunk = list(islice(rows, batch_size))
+                if not chunk:
+                    break
+                # chiavi duplicate nello stesso blocco renderebbero l'UPDATE ... FROM non deterministico: vince l'ultima
+                chunk = list(OrderedDict((tuple(row.get(col) for col in key_columns), row) for row in chunk).values())
+                if use_copy:
+                    use_copy = self.copyChunk(cursor, copy_sql, all_columns, chunk)
+                if not use_copy:
+                    self.insertValues(cursor, temp_table, all_columns, [[row.get(col) for col in all_columns] for row in chunk], page_size=batch_size)
+                cursor.execute(update_sql)
+                updated += cursor.rowcount
+                cursor.execute("TRUNCATE {}".format(temp_table))
+            cursor.execute("DROP TABLE {}".format(temp_table))
+            if commit:
+                self.connection.commit()
+        finally:
+            cursor.close()
+        return updated
 
-    # Da capire
     def insertListOfDictsIntoTable(self, table_name, l, dt_cols=[], commit=False):
         cols = sorted(list(l[0].keys()))
 
         if dt_cols:
-            non_dt_cols = list(set(cols) - set(dt_cols))
+            non_dt_cols = sorted(set(cols) - set(dt_cols))
         else:
             non_dt_cols = cols
 
-        cols = non_dt_cols + dt_cols
+        self.copyRecordsIntoTable(table_name, l, non_dt_cols + dt_cols, dt_cols, commit=commit)
 
-        l = [[dic[col] for col in cols] for dic in l]
-
-        print("insertListOfDictsIntoTable l = {}".format(l))
-        self.insertListIntoTable(table_name, l, non_dt_cols, dt_cols)
-
-        if commit:
-            self.connection.commit()
-
-    def insertListIntoTable(self, table_name, l, non_dt_cols, dt_cols=[]):
+    def insertListIntoTable(self, table_name, l, non_dt_cols, dt_cols=[], commit=False):
         '''
         The first values of each row should represent non-datetime fields.
         '''
-        print("insertListIntoTable l = {}".format(l))
-        print("insertListIntoTable dt_cols = {}".format(dt_cols))
-        brackets_str = ", ".join(["{}"] * len(non_dt_cols))
-        if dt_cols:
-            brackets_str += ", "
-            brackets_str += ", ".join(["to_timestamp({}, 'yyyy-MM-dd HH24:mi:ss')"] * len(dt_cols))
-        n_cols = len(dt_cols) + len(non_dt_cols)
-        # brackets_str = brackets_str.format( *[":" + str( i + 1 ) for i in range( 0, n_cols )] )
-        brackets_str = brackets_str.format(*["?" for i in range(0, n_cols)])
-
-        cols_str = ", ".join(non_dt_cols + dt_cols)
-
-        query = "INSERT INTO {} ({}) VALUES ({})".format(table_name, cols_str, brackets_str)
-        print("insertListIntoTable query = {}".format(query))
-        print("insertListIntoTable cols_str = {}".format(cols_str))
-        print("insertListIntoTable brackets_str = {}".format(brackets_str))
+        if self.connected:
+            cursor = self.connection.cursor()
+            try:
+                self.insertValues(cursor, table_name, non_dt_cols + dt_cols, l, dt_cols)
+                if commit:
+                    self.connection.commit()
+            finally:
+                cursor.close()
 
-        self.executeMany(query, l)
+    def copyRecordsIntoTable(self, table_name, records, columns=None, dt_cols=[], chunk_size=10000, commit=False, use_copy=True):
+        ''' Caricamento massivo di un iterabile di dict nella tabella tramite COPY ... FROM STDIN, a blocchi di chunk_size
+            righe serializzati in un buffer in memoria. Le colonne di default sono le chiavi (ordinate) del primo record;
+            le chiavi mancanti vengono caricate come NULL. Se la COPY non e' consentita (o use_copy e' False) il caricamento
+            prosegue con INSERT multi-riga (VALUES) a blocchi. Ritorna il numero di righe caricate.
+        '''
+        if not self.connected:
+            return 0
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            return 0
+        columns = columns if columns else sorted(first.keys())
+        dt_cols = set(dt_cols)
+        copy_sql = "COPY {} ({}) FROM STDIN".format(table_name, ", ".join(columns))
+        records = chain([first], records)
+        loaded = 0
+        cursor = self.connection.cursor()
+        try:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                if use_copy:
+                    use_copy = self.copyChunk(cursor, copy_sql, columns, chunk)
+                if not use_copy:
+                    self.insertValues(cursor, table_name, columns, [[record.get(col) for col in columns] for record in chunk], dt_cols, chunk_size)
+                loaded += len(chunk)
+            if commit:
+                self.connection.commit()
+        finally:
+            cursor.close()
+        return loaded
+
+    def copyChunk(self, cursor, copy_sql, columns, chunk):
+        ''' Esegue la COPY di un blocco di record; ritorna False (annullando il blocco) se la COPY non e' consentita. '''
+        buf = io.StringIO()
+        for record in chunk:
+            buf.write("\t".join(self.copyValue(record.get(col)) for col in columns))
+            buf.write("\n")
+        buf.seek(0)
+        savepoint = not self.connection.autocommit
+        if savepoint:
+            cursor.execute("SAVEPOINT dq_copy_chunk")
+        try:
+            cursor.copy_expert(copy_sql, buf)
+        except (psycopg2.NotSupportedError, psycopg2.ProgrammingError):
+            if not savepoint:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT dq_copy_chunk")
+            return False
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT dq_copy_chunk")
+        return True
+
+    COPY_ESCAPES = {ord("\\"): "\\\\", ord("\t"): "\\t", ord("\n"): "\\n", ord("\r"): "\\r"}
+
+    def copyValue(self, value):
+        ''' Serializza un valore nel formato testo della COPY (NULL = \\N, escape di backslash, tab e a capo). '''
+        if value is None:
+            return "\\N"
+        if isinstance(value, bool):
+            return "t" if value else "f"
+        if isinstance(value, datetime):
+            return value.strftime(self.DATETIME_FORMAT)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        return str(value).translate(self.COPY_ESCAPES)
+
+    def insertValues(self, cursor, table_name, columns, rows, dt_cols=[], page_size=1000):
+        ''' INSERT multi-riga (VALUES) di una lista di righe; le colonne in dt_cols passano da to_timestamp. '''
+        template = "({})".format(", ".join("to_timestamp(%s, 'yyyy-MM-dd HH24:mi:ss')" if col in dt_cols else "%s" for col in columns))
+        query = "INSERT INTO {} ({}) VALUES %s".format(table_name, ", ".join(columns))
+        rows = [[self.bindValue(value) for value in row] for row in rows]
+        psycopg2.extras.execute_values(cursor, query, rows, template=template, page_size=page_size)
+
+    def bindValue(self, value):
+        if isinstance(value, datetime):
+            return value.strftime(self.DATETIME_FORMAT)
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
 
     def executeProcedure(self, procname, commit=False, parameters=None):
         if self.connected:
@@ -474,4 +944,493 @@ class Db:
             finally:
                 cursor.close()
         else:
-            pass
\ No newline at end of file
+            pass
+
+class PooledDb(Db):
+    ''' Variante di Db basata su ThreadedConnectionPool: ogni thread prende in prestito dal pool una propria
+        connessione al primo utilizzo e la usa per tutte le operazioni (stessa api di Db). Con releaseConnection
+        (o usando il context manager checkout) il thread restituisce la connessione al pool; la connessione di un
+        thread terminato senza restituirla viene recuperata (con rollback) quando il thread viene distrutto.
+        Se il pool e' esaurito si attende fino a timeout secondi che una connessione venga restituita, poi viene
+        sollevata DatabaseError. '''
+
+    class Checkout(object):
+        ''' Connessione presa in prestito da un thread, restituita al pool dal finalizer se il thread termina. '''
+        def __init__(self, conn):
+            self.conn = conn
+            self.finalizer = None
+
+    def __init__(self, db_host, db_database, user, password, schema=None, port=None, minconn=1, maxconn=5, prepared_cache_size=0,
+                 timeout=30):
+        self.pool = None
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.local = threading.local()
+        super(PooledDb, self).__init__(db_host, db_database, user, password, schema, port, prepared_cache_size)
+
+    @property
+    def connection(self):
+        checkout = getattr(self.local, "checkout", None)
+        if checkout is None:
+            if self.pool is None:
+                return None
+            checkout = self.acquire()
+        return checkout.conn
+
+    @connection.setter
+    def connection(self, conn):
+        if conn is None:
+            self.releaseConnection(commit=False)
+        else:
+            self.local.checkout = self.Checkout(conn)
+
+    def createPool(self):
+        return ThreadedConnectionPool(self.minconn, self.maxconn, **self.connectionParams())
+
+    def openConnection(self):
+        try:
+            self.pool = self.createPool()
+            self.connected = True
+        except Exception as e:
+            raise self.DatabaseError(e)
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise self.DatabaseError(PoolError("connection pool exhausted: nessuna connessione libera dopo {} secondi".format(self.timeout)))
+        try:
+            checkout = self.Checkout(self.pool.getconn())
+        except Exception:
+            self.slots.release()
+            raise
+        checkout.finalizer = weakref.finalize(checkout, self.putBack, checkout.conn)
+        self.local.checkout = checkout
+        return checkout
+
+    def putBack(self, conn, commit=False, close=False):
+        try:
+            if commit and not conn.closed:
+                conn.commit()
+            if not self.pool.closed:
+                self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+    def releaseConnection(self, commit=True, close=False):
+        ''' Restituisce al pool la connessione del thread corrente (con commit se richiesto). '''
+        checkout = getattr(self.local, "checkout", None)
+        if checkout is not None:
+            self.local.checkout = None
+            if checkout.finalizer is not None and checkout.finalizer.detach() is not None:
+                self.putBack(checkout.conn, commit=commit, close=close)
+
+    @contextmanager
+    def checkout(self, commit=True):
+        ''' Context manager che presta al thread corrente una connessione del pool e la restituisce all'uscita
+            (con commit se richiesto e se non ci sono stati errori, altrimenti con rollback). '''
+        conn = self.connection
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            self.releaseConnection(commit=False)
+            raise
+        else:
+            self.releaseConnection(commit=commit)
+
+    def close(self):
+        if self.connected:
+            self.releaseConnection(commit=True)
+            self.pool.closeall()
+            self.connected = False
+
+    def resetConnection(self):
+        self.releaseConnection(commit=False, close=True)
+
+
+class LookupTableCache:
+    ''' Cache in memoria delle tabelle parametriche di lookup (es. special_char_table e string_poss_table).
+        Ogni tabella viene letta dal db una sola volta e servita dalla memoria fino alla scadenza del ttl
+        (in secondi, None = nessuna scadenza). Se e' configurata una version_column (es. updated_at), alla
+        scadenza del ttl viene letto solo max(version_column) e la tabella viene ricaricata solo se cambiato.
+        Le strutture derivate (indici, automi, ...) registrate con getDerived vengono ricostruite ad ogni refresh.
+    '''
+
+    def __init__(self, dbClient, schema, ttl=None, version_column=None, logger=None):
+        self.dbClient = dbClient
+        self.schema = schema
+        self.ttl = ttl
+        self.version_column = version_column
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.version_checks = 0
+        self._tables = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def _loadTable(self, table_name):
+        rows = self.dbClient.executeQuery("SELECT * from {}.{}".format(self.schema, table_name), isSelect=True)
+        return list(rows) if rows else []
+
+    def _readVersion(self, table_name):
+        if not self.version_column:
+            return None
+        res = self.dbClient.executeQuery("SELECT max({}) from {}.{}".format(self.version_column, self.schema, table_name), isSelect=True)
+        return res[0][0] if res else None
+
+    def _isExpired(self, entry):
+        return entry["stale"] or (self.ttl is not None and time.time() - entry["checked_at"] >= self.ttl)
+
+    def _store(self, table_name, generation):
+        version = self._readVersion(table_name)
+        entry = {
+            "rows": self._loadTable(table_name),
+            "version": version,
+            "checked_at": time.time(),
+            "generation": generation,
+            "stale": False,
+            "derived": {}
+        }
+        self._tables[table_name] = entry
+        return entry
+
+    def _getEntry(self, table_name):
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is None:
+                self.misses += 1
+                if self.logger:
+                    self.logger.debug("LookupTableCache - caricamento tabella '%s'", table_name)
+                return self._store(table_name, 0)
+            if self._isExpired(entry):
+                if self.version_column and not entry["stale"]:
+                    self.version_checks += 1
+                    if self._readVersion(table_name) == entry["version"]:
+                        entry["checked_at"] = time.time()
+                        self.hits += 1
+                        return entry
+                self.refreshes += 1
+                if self.logger:
+                    self.logger.info("LookupTableCache - refresh tabella '%s'", table_name)
+                entry = self._store(table_name, entry["generation"] + 1)
+                for listener in self._listeners:
+                    listener(table_name)
+                return entry
+            self.hits += 1
+            return entry
+
+    def get(self, table_name):
+        ''' Ritorna le righe della tabella table_name, caricandole dal db solo se necessario. '''
+        return self._getEntry(table_name)["rows"]
+
+    def getDerived(self, table_name, name, builder):
+        ''' Ritorna la struttura derivata 'name' costruita con builder(rows) a partire dallo snapshot corrente
+            della tabella. La struttura viene ricostruita solo quando la tabella viene ricaricata. '''
+        with self._lock:
+            entry = self._getEntry(table_name)
+            if name not in entry["derived"]:
+                entry["derived"][name] = builder(entry["rows"])
+            return entry["derived"][name]
+
+    def generation(self, table_name):
+        ''' Numero di refresh effettuati sullo snapshot della tabella (-1 se non ancora caricata). '''
+        entry = self._tables.get(table_name)
+        return entry["generation"] if entry is not None else -1
+
+    def addRefreshListener(self, callback):
+        ''' Registra una callback(table_name) invocata ad ogni refresh o invalidazione di una tabella. '''
+        self._listeners.append(callback)
+
+    def invalidate(self, table_name=None):
+        ''' Forza la rilettura dal db della tabella indicata (o di tutte se table_name e' None) al prossimo accesso,
+            indipendentemente dal ttl, e notifica i listener. '''
+        with self._lock:
+            names = [table_name] if table_name else list(self._tables.keys())
+            names = [name for name in names if name in self._tables]
+            for name in names:
+                self._tables[name]["stale"] = True
+        for name in names:
+            for listener in self._listeners:
+                listener(name)
+
+    def getStats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "version_checks": self.version_checks,
+            "hit_rate": float(self.hits) / total if total else 0.0,
+            "tables": dict((name, len(entry["rows"])) for name, entry in self._tables.items())
+        }
+
+
+class RecordIdAllocator:
+    ''' Assegna gli identificativi dei record prenotandoli a blocchi di block_size con una sola query e servendoli
+        da un buffer locale che si ricarica automaticamente. Il blocco viene ottenuto:
+        - chiamando la funzione id_function su generate_series(1, n), oppure
+        - tramite range_function(app_name, n), se configurata, che deve restituire n identificativi (uno per riga).
+        L'unicita' tra worker concorrenti e' garantita dalla funzione sul db (sequence); gli identificativi
+        prenotati e non utilizzati a fine esecuzione vengono persi (buchi nella numerazione).
+    '''
+
+    def __init__(self, dbClient, schema, id_function, app_name, block_size=1, range_function=None):
+        self.dbClient = dbClient
+        self.schema = schema
+        self.id_function = id_function
+        self.app_name = app_name
+        self.block_size = max(int(block_size or 1), 1)
+        self.range_function = range_function
+        self.queries = 0
+        self.allocated = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+
+    def _reserve(self, n):
+        if n == 1 and not self.range_function:
+            res = self.dbClient.executeQuery("SELECT * from {}.{}(%s);".format(self.schema, self.id_function), (self.app_name,), isSelect=True)
+        elif self.range_function:
+            res = self.dbClient.executeQuery("SELECT * from {}.{}(%s, %s);".format(self.schema, self.range_function), (self.app_name, n), isSelect=True)
+        else:
+            res = self.dbClient.executeQuery("SELECT {}.{}(%s) from generate_series(1, %s);".format(self.schema, self.id_function), (self.app_name, n), isSelect=True)
+        self.queries += 1
+        self._buffer.extend(row[0] for row in res)
+
+    def take(self, n=1):
+        ''' Ritorna una lista di n identificativi, prenotando dal db solo la parte mancante nel buffer
+            (almeno block_size identificativi per query). '''
+        with self._lock:
+            missing = n - len(self._buffer)
+            if missing > 0:
+                self._reserve(max(missing, self.block_size))
+            self.allocated += n
+            return [self._buffer.popleft() for i in range(n)]
+
+    def next(self):
+        return self.take(1)[0]
+
+    def getStats(self):
+        return {"allocated": self.allocated, "queries": self.queries, "buffered": len(self._buffer), "block_size": self.block_size}
+
+
+class LruCache:
+    ''' Cache a dimensione limitata con politica di eviction LRU e contatori hit/miss. '''
+    MISSING = object()
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Ritorna il valore associato alla chiave oppure LruCache.MISSING. '''
+        with self._lock:
+            value = self._data.get(key, self.MISSING)
+            if value is self.MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.invalidations += 1
+
+    def getStats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": float(self.hits) / total if total else 0.0
+        }
+
+
+class Metrics:
+    ''' Raccolta delle metriche di esecuzione: numero di chiamate, tempo cumulato, percentili di latenza (su un
+        campione di al piu' SAMPLE_SIZE misure per metrica) e record al secondo, per metodo e per statement sql.
+        Gli oggetti vengono strumentati solo con instrument/instrumentDb: se le metriche non sono attive non
+        c'e' alcun costo aggiuntivo. '''
+    SAMPLE_SIZE = 10000
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.methods = dict()
+        self.queries = dict()
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, group, name, elapsed, records=1):
+        with self._lock:
+            stat = group.get(name)
+            if stat is None:
+                stat = group[name] = {"count": 0, "total": 0.0, "max": 0.0, "records": 0, "samples": []}
+            stat["count"] += 1
+            stat["total"] += elapsed
+            stat["records"] += records
+            stat["max"] = max(stat["max"], elapsed)
+            if len(stat["samples"]) < self.SAMPLE_SIZE:
+                stat["samples"].append(elapsed)
+            else:
+                i = random.randrange(stat["count"])
+                if i < self.SAMPLE_SIZE:
+                    stat["samples"][i] = elapsed
+
+    def timed(self, group, name, method, keyFromArgs=None):
+        ''' Ritorna method avvolto dalla misura del tempo. Se keyFromArgs (funzione del primo argomento) e' passato,
+            la metrica e' indicizzata per la chiave calcolata (es. operazione e tabella dello statement sql).
+            I record sono la lunghezza della lista in input; se l'input e' un iteratore vengono contati gli elementi
+            consumati e se il metodo ritorna un generatore quelli prodotti (misurando anche il tempo di produzione).
+        '''
+        def wrapper(*args, **kwargs):
+            key = keyFromArgs(args[0]) if keyFromArgs and args else name
+            consumed = None
+            if args and not keyFromArgs and isinstance(args[0], Iterator):
+                consumed = [0]
+                args = (self.countItems(args[0], consumed),) + args[1:]
+            start = time.perf_counter()
+            result = None
+            try:
+                result = method(*args, **kwargs)
+                if isinstance(result, GeneratorType):
+                    return self.timedGenerator(group, key, result, time.perf_counter() - start)
+                return result
+            finally:
+                if not isinstance(result, GeneratorType):
+                    self.record(group, key, time.perf_counter() - start, self.countRecords(args, consumed, keyFromArgs))
+        return wrapper
+
+    def countRecords(self, args, consumed, keyFromArgs):
+        if consumed is not None:
+            return consumed[0]
+        data = args[1] if keyFromArgs and len(args) > 1 else args[0] if args and not keyFromArgs else None
+        return len(data) if isinstance(data, list) else 1
+
+    def countItems(self, iterator, consumed):
+        for item in iterator:
+            consumed[0] += 1
+            yield item
+
+    def timedGenerator(self, group, key, generator, elapsed):
+        ''' Rilancia gli elementi del generatore misurando solo il tempo speso a produrli; la metrica viene registrata
+            all'esaurimento (o alla chiusura) del generatore, con il numero di elementi prodotti. '''
+        records = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                records += 1
+                yield item
+        finally:
+            generator.close()
+            self.record(group, key, elapsed, records)
+
+    QUERY_TABLE = {
+        "SELECT": re.compile(r"\bfrom\s+([\w.\"]+)", re.I),
+        "DELETE": re.compile(r"\bfrom\s+([\w.\"]+)", re.I),
+        "INSERT": re.compile(r"\binto\s+([\w.\"]+)", re.I)
+    }
+    QUERY_TABLE_DEFAULT = re.compile(r"^\s*\w+\s+(?:table\s+|only\s+)?([\w.\"]+)", re.I)
+
+    def queryKey(self, query):
+        ''' Chiave della metrica di uno statement: operazione e tabella (es. "SELECT dq.special_char"), cosi' che
+            eventuali valori inline nel testo sql non moltiplichino le serie. '''
+        query = str(query)
+        words = query.split(None, 1)
+        if not words:
+            return "?"
+        op = words[0].upper()
+        match = self.QUERY_TABLE.get(op, self.QUERY_TABLE_DEFAULT).search(query)
+        return "{} {}".format(op, match.group(1)) if match else op
+
+    def instrument(self, obj, names):
+        ''' Strumenta i metodi names dell'oggetto obj (sostituendoli sull'istanza). '''
+        for name in names:
+            setattr(obj, name, self.timed(self.methods, name, getattr(obj, name)))
+
+    def instrumentDb(self, dbClient):
+        ''' Strumenta le chiamate al db, con metriche separate per operazione e tabella (CALL e nome per le procedure).
+            Un client gia' strumentato (es. il client condiviso restituito da getDbClient) non viene avvolto una
+            seconda volta. '''
+        if getattr(dbClient, "metrics_instrumented", False):
+            return
+        for name in ("executeQuery", "executeMany"):
+            setattr(dbClient, name, self.timed(self.queries, name, getattr(dbClient, name), keyFromArgs=self.queryKey))
+        dbClient.executeProcedure = self.timed(self.queries, "executeProcedure", dbClient.executeProcedure,
+                                               keyFromArgs=lambda procname: "CALL {}".format(procname))
+        dbClient.metrics_instrumented = True
+
+    def summarize(self, stat):
+        samples = sorted(stat["samples"])
+        summary = {
+            "count": stat["count"],
+            "total_seconds": stat["total"],
+            "mean_seconds": stat["total"] / stat["count"] if stat["count"] else 0.0,
+            "max_seconds": stat["max"],
+            "records": stat["records"],
+            "records_per_second": stat["records"] / stat["total"] if stat["total"] else 0.0
+        }
+        for q in self.QUANTILES:
+            summary["p{}".format(int(q * 100))] = samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+        return summary
+
+    def getStats(self):
+        with self._lock:
+            return {
+                "elapsed_seconds": time.time() - self.started_at,
+                "methods": dict((name, self.summarize(stat)) for name, stat in self.methods.items()),
+                "queries": dict((name, self.summarize(stat)) for name, stat in self.queries.items())
+            }
+
+    def dumpJson(self, path):
+        with open(path, "w") as f:
+            json.dump(self.getStats(), f, indent=4, sort_keys=True)
+
+    def escapeLabel(self, value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def dumpPrometheus(self, path, prefix="dataquality"):
+        ''' Scrive le metriche in formato testuale Prometheus (es. per il node_exporter textfile collector). '''
+        stats = self.getStats()
+        lines = []
+        for group, label in (("methods", "method"), ("queries", "query")):
+            metric = "{}_{}".format(prefix, "method" if group == "methods" else "db_query")
+            lines.append("# TYPE {}_seconds summary".format(metric))
+            for name, summary in sorted(stats[group].items()):
+                value = self.escapeLabel(name)
+                for q in self.QUANTILES:
+                    lines.append("{}_seconds{{{}=\"{}\",quantile=\"{}\"}} {}".format(metric, label, value, q, summary["p{}".format(int(q * 100))]))
+                lines.append("{}_seconds_sum{{{}=\"{}\"}} {}".format(metric, label, value, summary["total_seconds"]))
+                lines.append("{}_seconds_count{{{}=\"{}\"}} {}".format(metric, label, value, summary["count"]))
+            lines.append("# TYPE {}_records_per_second gauge".format(metric))
+            for name, summary in sorted(stats[group].items()):
+                value = self.escapeLabel(name)
+                lines.append("{}_records_per_second{{{}=\"{}\"}} {}".format(metric, label, value, summary["records_per_second"]))
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")